@@ -1,4 +1,8 @@
 from __future__ import print_function, absolute_import
+import binascii
+import threading
+import zlib
+
 from . import libssdeep_wrapper
 from . import sdhash_wrapper
 from . import tlsh_wrapper
@@ -15,6 +19,10 @@ Supports:
 This also ships with built libraries for the supported algorithms in order
 to minimise extenal dependencies.
 
+Hash objects may be shared between threads; each object serialises access
+to its own native state. Only ssdeep releases the GIL while in native code,
+see ThreadPoolHasher for hashing many buffers with threads.
+
 [sptonkin@outlook.com]"""
 
 
@@ -39,6 +47,11 @@ class ssdeep(object):
     update() -- updates the current digest with an additional string
     hexdigest() -- return the current digest as a string of hex digits
     copy() -  returns a copy of the current hash object
+    reset() -- clears the object for reuse, reusing its native state
+
+    ssdeep objects can be pickled, including objects which are still being
+    updated, although the pickled state of these can only be loaded using
+    the same libssdeep; loading it with another raises SsdeepError.
 
     Attributes:
 
@@ -48,10 +61,14 @@ class ssdeep(object):
     Operators:
         
     __sub__ -- instances can have hashes compared with subtraction (-)
-    __eq__ -- instances can be tested for hash equivalency (==)"""
+    __eq__ -- instances can be tested for hash equivalency (==)
+
+    ssdeep objects are thread-safe and the GIL is released while libssdeep
+    updates, digests and compares."""
 
     name = "ssdeep"
     digest_size = libssdeep_wrapper.FUZZY_MAX_RESULT
+    releases_gil = True
 
     def __init__(self, buf=None, hash=None):
         """Initialises a ssdeep object. Can be initialised with either a
@@ -64,10 +81,13 @@ class ssdeep(object):
         initialisation, buf will be used and hash will be ignored."""
         self.name = "ssdeep"
         self.digest_size = libssdeep_wrapper.FUZZY_MAX_RESULT
-        self._state = libssdeep_wrapper.fuzzy_new()
+        self._lock = threading.Lock()
+        # Objects created from a hash never need a fuzzy_state.
+        self._state = None
         if buf is not None:
             self._updatable = True
             self._pre_computed_hash = None
+            self._state = libssdeep_wrapper.fuzzy_new()
             self.update(buf)
         elif hash is not None:
             self._updatable = False
@@ -75,9 +95,30 @@ class ssdeep(object):
         else:
             raise ValueError("one of buf or hash must be set")
             
+    def __getstate__(self):
+        if self._pre_computed_hash is None:
+            with self._lock:
+                state = libssdeep_wrapper.fuzzy_save_state(self._state)
+            return None, zlib.compress(state)
+        else:
+            return self._pre_computed_hash, None
+
+    def __setstate__(self, state):
+        self.name = "ssdeep"
+        self.digest_size = libssdeep_wrapper.FUZZY_MAX_RESULT
+        self._lock = threading.Lock()
+        self._state = None
+        self._pre_computed_hash, saved = state
+        self._updatable = self._pre_computed_hash is None
+        if saved is not None:
+            self._state = libssdeep_wrapper.fuzzy_new()
+            libssdeep_wrapper.fuzzy_load_state(self._state,
+                                               zlib.decompress(saved))
+
     def __del__(self):
         try:
-            libssdeep_wrapper.fuzzy_free(self._state)
+            if self._state is not None:
+                libssdeep_wrapper.fuzzy_free(self._state)
         except AttributeError:
             # On Python shutdown it seems like libssdeep_wrapper may get
             # freed first, it seems?
@@ -86,29 +127,51 @@ class ssdeep(object):
     def hexdigest(self):
         """Return the digest value as a string of hexadecimal digits."""
         if self._pre_computed_hash is None:
-            return libssdeep_wrapper.fuzzy_digest(self._state, 0)
+            with self._lock:
+                return libssdeep_wrapper.fuzzy_digest(self._state, 0)
         else:
             return self._pre_computed_hash
 
     def update(self, buf):
         """Update this hash object's state with the provided string."""
         if self._updatable:
-            return libssdeep_wrapper.fuzzy_update(self._state, buf)
+            with self._lock:
+                return libssdeep_wrapper.fuzzy_update(self._state, buf)
         else:
             raise InvalidOperation("Cannot update sdeep created from hash")
 
     def copy(self):
         """Returns a new instance which identical to this instance."""
-        if self._pre_computed_hash is None:
-            temp = ssdeep(buf="")
-        else:
-            temp = ssdeep(hash=hash)
-        libssdeep_wrapper.fuzzy_free(temp._state)
-        temp._state = libssdeep_wrapper.fuzzy_clone(self._state)
+        temp = ssdeep.__new__(ssdeep)
+        temp.name = self.name
+        temp.digest_size = self.digest_size
+        temp._lock = threading.Lock()
+        temp._state = None
         temp._updatable = self._updatable
         temp._pre_computed_hash = self._pre_computed_hash
+        if self._state is not None:
+            with self._lock:
+                temp._state = libssdeep_wrapper.fuzzy_clone(self._state)
         return temp
 
+    def reset(self):
+        """Returns this object to the state of one created from an empty
+        buffer, so that it can be updated with a new input. The native
+        fuzzy_state is reused rather than freed and reallocated."""
+        with self._lock:
+            if self._state is None:
+                self._state = libssdeep_wrapper.fuzzy_new()
+            else:
+                try:
+                    libssdeep_wrapper.fuzzy_reset(self._state)
+                except libssdeep_wrapper.SsdeepError:
+                    # The state cannot be restored in place on this platform.
+                    libssdeep_wrapper.fuzzy_free(self._state)
+                    self._state = None
+                    self._state = libssdeep_wrapper.fuzzy_new()
+            self._updatable = True
+            self._pre_computed_hash = None
+
     def compare(self, b):
         return libssdeep_wrapper.compare(self.hexdigest(), b.hexdigest())
 
@@ -138,6 +201,14 @@ class sdhash(object):
     hexdigest() -- return the current digest as a string of hex digits
     copy() -  returns a copy of the current hash object
 
+    sdhash objects can be pickled. Unpickled objects are only parsed once
+    they are first compared.
+
+    Digests are only serialised once per object, and parsed digests are
+    cached, so equality tests, copies and repeatedly loading the same digest
+    are cheap. The cache holds up to 16MB of digests by default; use
+    sdhash_wrapper.sdbf_cache.resize() to change this (0 disables it).
+
     Attributes:
 
     name -- the name of the algorithm being used (ie. "sdhash")
@@ -145,9 +216,13 @@ class sdhash(object):
     Operators:
         
     __sub__ -- instances can have hashes compared with subtraction (-)
-    __eq__ -- instances can be tested for hash equivalency (==)"""
+    __eq__ -- instances can be tested for hash equivalency (==)
+
+    sdhash objects are immutable once created and so are thread-safe, but
+    the GIL is held while sdbf digests and compares."""
 
     name = "sdhash"
+    releases_gil = False
 
     def __init__(self, buf=None, hash=None):
         """Initialises a sdhash object. Can be initialised with either a
@@ -157,27 +232,47 @@ class sdhash(object):
         Note that sdhash objects do not support update().
 
         Note that if both buf and hash parameters are provided on
-        initialisation, buf will be used and hash will be ignored."""
+        initialisation, buf will be used and hash will be ignored.
+
+        hexdigest() of an object initialised with hash returns hash, ending
+        with a single newline as sdhash's own digests do."""
+        self._hash = None
         if buf is not None:
             if len(buf) < 512:
                 raise ValueError("sdhash requires buffer >= 512 in size")
-            self._sdbf = sdhash_wrapper.sdbf_from_buffer(buf)
+            self._parsed = sdhash_wrapper.sdbf_from_buffer(buf)
         elif hash is not None:
-            self._sdbf = sdhash_wrapper.sdbf_from_hash(hash)
+            self._hash = hash.rstrip("\n") + "\n"
+            self._parsed = sdhash_wrapper.sdbf_from_hash(self._hash)
         else:
             raise ValueError("One of buf or hash must be set.")
 
-    def __del__(self):
-        if hasattr(self, "_sdbf"):
-            del self._sdbf 
+    def __getstate__(self):
+        return self.hexdigest()
+
+    def __setstate__(self, state):
+        self._parsed = None
+        self._hash = state
+
+    @property
+    def _sdbf(self):
+        if self._parsed is None:
+            self._parsed = sdhash_wrapper.sdbf_from_hash(self._hash)
+        return self._parsed
 
     def hexdigest(self):
         """Return the digest value as a string of hexadecimal digits."""
-        return self._sdbf.to_string()
+        # sdhash objects are immutable, so the digest need only be made once.
+        if self._hash is None:
+            self._hash = self._parsed.to_string()
+        return self._hash
 
     def copy(self):
         """Returns a new instance which identical to this instance."""
-        return sdhash(hash=self.hexdigest())
+        temp = sdhash.__new__(sdhash)
+        temp._parsed = self._parsed
+        temp._hash = self._hash
+        return temp
 
     @staticmethod
     def update(self, *args):
@@ -217,6 +312,10 @@ class tlsh(object):
     diff() -- calls the underlying diff method for Tlsh objects
     diffxlen() -- calls the underlying diffxlen method for Tlsh objects,
                   which ignores length checks
+    reset() -- clears the object for reuse
+
+    tlsh objects can be pickled. As with copy(), pickling will 'finalise'
+    a tlsh object.
 
     Attributes:
 
@@ -225,9 +324,13 @@ class tlsh(object):
     Operators:
 
     __sub__ -- instances can have hashes compared with subtraction (-)
-    __eq__ -- instances can be tested for hash equivalency (==)"""
+    __eq__ -- instances can be tested for hash equivalency (==)
+
+    tlsh objects are thread-safe, but the GIL is held while Tlsh updates,
+    finalises and diffs."""
 
     name = "tlsh"
+    releases_gil = False
 
     _MIN_LEN = 256
 
@@ -249,39 +352,68 @@ class tlsh(object):
         initialisation, buf will be used and hash will be ignored."""
 
         self._buf_len = 0
-	self._final = False
-        self._tlsh = tlsh_wrapper.Tlsh()
+        self._final = False
+        self._lock = threading.Lock()
+        # Each Tlsh leaks a little memory in the extension, so they are
+        # only created for objects which are updated. Once final, only
+        # the digest (_hash) is kept.
+        self._tlsh = None
+        self._hash = None
 
         if buf is not None:
+            self._tlsh = tlsh_wrapper.Tlsh()
             self.update(buf)
         elif hash is not None:
-            self._tlsh.fromTlshStr(hash)
-	    self._final = True
+            # Raises ValueError if hash is not a TLSH hex string.
+            tlsh_wrapper.diff(hash, hash)
+            self._hash = hash.upper()
+            self._final = True
         else:
             raise ValueError("One of buf or hash must be set.")
 
+    def __getstate__(self):
+        return binascii.unhexlify(self.hexdigest())
+
+    def __setstate__(self, state):
+        self._buf_len = 0
+        self._final = True
+        self._lock = threading.Lock()
+        self._tlsh = None
+        self._hash = binascii.hexlify(state).upper()
+
     def __del__(self):
-        if hasattr(self, "_tlsh") and not self._final:
-            # TODO: investigate potential small leak in underlying class?
+        if getattr(self, "_tlsh", None) is not None:
+            self._release()
+
+    def _release(self):
+        if not self._final:
+            # Finalising frees the buffers used while updating.
             try:
                 self._tlsh.final()
             except ValueError:
                 # ValueError on small buffer OK. Else, raise.
                 if self._buf_len >= self._MIN_LEN:
                     raise
-            del self._tlsh
+        self._tlsh = None
 
     def hexdigest(self):
         """Return the digest value as a string of hexadecimal digits."""
-        if not self._final:
-            if self._buf_len >= self._MIN_LEN:
-                self._tlsh.final()
-                self._final = True
-            else:
-                raise ValueError("tlsh requires buffer with length >= %d "
-                                 "for mode where force = %s" % \
-                                 (self._MIN_LEN, False))
-        return self._tlsh.hexdigest()
+        with self._lock:
+            if not self._final:
+                if self._buf_len >= self._MIN_LEN:
+                    self._tlsh.final()
+                    self._final = True
+                else:
+                    raise ValueError("tlsh requires buffer with length >= %d "
+                                     "for mode where force = %s" % \
+                                     (self._MIN_LEN, False))
+            if self._hash is None:
+                # Raises ValueError (on every call) if the input has too
+                # little variation, so the Tlsh is only dropped once the
+                # digest has been made.
+                self._hash = self._tlsh.hexdigest()
+                self._tlsh = None
+            return self._hash
 
     def copy(self):
         """Returns a new instance which identical to finalised version
@@ -290,11 +422,26 @@ class tlsh(object):
 
     def update(self, buf):
         """Update this hash object's state with the provided string."""
-        if self._final:
-            raise InvalidOperation("Cannot update finalised tlsh")
-        else:
-	    self._buf_len += len(buf)
-            return self._tlsh.update(buf)
+        with self._lock:
+            if self._final:
+                raise InvalidOperation("Cannot update finalised tlsh")
+            else:
+                self._buf_len += len(buf)
+                return self._tlsh.update(buf)
+
+    def reset(self):
+        """Returns this object to the state of one created from an empty
+        buffer, so that it can be updated with a new input. Note that a
+        Tlsh cannot be reused once updated, so a new one is created unless
+        this object has not yet been updated."""
+        with self._lock:
+            if self._tlsh is not None and self._buf_len:
+                self._release()
+            if self._tlsh is None:
+                self._tlsh = tlsh_wrapper.Tlsh()
+            self._buf_len = 0
+            self._final = False
+            self._hash = None
 
     def diff(self, b):
         if isinstance(b, tlsh):
@@ -327,3 +474,43 @@ class tlsh(object):
             return self.hexdigest() ==  b
         else:
             return False
+
+
+algorithms_available = ("ssdeep", "sdhash", "tlsh")
+
+
+def new(name, buf=None, hash=None):
+    """Returns a new hash object for the algorithm called name, in the same
+    manner as hashlib.new(). buf and hash are passed on to the constructor
+    of the selected class."""
+    try:
+        cls = {"ssdeep": ssdeep, "sdhash": sdhash, "tlsh": tlsh}[name]
+    except KeyError:
+        raise ValueError("unsupported hash type %s" % name)
+    return cls(buf=buf, hash=hash)
+
+
+def hash_many(bufs, name):
+    """Returns a list of hexdigests, one for each buffer in bufs, computed
+    with the algorithm called name. Buffers which are too small for the
+    algorithm to hash have a digest of None.
+
+    This avoids creating a hash object for every buffer, so is much faster
+    than new() for large numbers of small buffers. ssdeep uses libssdeep's
+    fuzzy_hash_buf() with a single result buffer and tlsh uses the Tlsh
+    extension's hash() function, while sdhash has no way to avoid parsing
+    each buffer into a new sdbf."""
+    if name == "ssdeep":
+        return libssdeep_wrapper.fuzzy_hash_buffers(bufs)
+    elif name == "tlsh":
+        return [tlsh_wrapper.hash(buf) or None for buf in bufs]
+    elif name == "sdhash":
+        return [sdhash_wrapper.sdbf_from_buffer(buf).to_string()
+                if len(buf) >= 512 else None for buf in bufs]
+    else:
+        raise ValueError("unsupported hash type %s" % name)
+
+
+from .threadpool import ThreadPoolHasher
+from .stream import StreamHasher, hash_stream
+from .hasherpool import HasherPool
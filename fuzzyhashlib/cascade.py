@@ -0,0 +1,233 @@
+from __future__ import print_function, absolute_import
+
+import time
+
+import fuzzyhashlib
+from .index import INDEXES
+
+"""
+Tiered similarity search of a fuzzyhashlib.db.DigestDB.
+
+The first stage uses a cheap algorithm which DigestDB can index (tlsh or
+ssdeep) to shortlist reference samples similar to the sample. Each later
+stage compares the sample with only the shortlisted references, using a
+more expensive algorithm (typically sdhash), and passes on those which
+match at that stage's threshold.
+
+Reference samples are identified by the name their digests were added to
+the DigestDB with, so every digest of a reference sample must share a
+name. A digest added without a name is a reference of its own, identified
+by its record id; as it has no digests of other algorithms it can only
+pass stages using its own algorithm.
+
+[sptonkin@outlook.com]
+"""
+
+
+# tlsh shortlists generously, sdhash confirms.
+DEFAULT_STAGES = (("tlsh", 100), ("sdhash", 1))
+
+
+class StageStats(object):
+    """How a single stage of a cascade_search() performed.
+
+    Attributes:
+
+    algorithm -- the name of the stage's algorithm
+    threshold -- the stage's threshold
+    candidates -- the number of stored digests the first stage's index
+                  selected for comparison, or the number of references
+                  considered by a later stage
+    passed -- the number of references which matched
+    seconds -- the time the stage took"""
+
+    def __init__(self, algorithm, threshold, candidates, passed, seconds):
+        self.algorithm = algorithm
+        self.threshold = threshold
+        self.candidates = candidates
+        self.passed = passed
+        self.seconds = seconds
+
+    @property
+    def rate(self):
+        """Returns the number of candidates considered per second."""
+        return self.candidates / self.seconds if self.seconds else 0.0
+
+    def __repr__(self):
+        return "<StageStats %s<=%s %d/%d %.3fs>" % (
+            self.algorithm, self.threshold, self.passed, self.candidates,
+            self.seconds)
+
+
+class CascadeResult(object):
+    """The result of a cascade_search().
+
+    Attributes:
+
+    matches -- a list of (name, scores) pairs for references matching at
+               every stage, where scores is a dict of algorithm to score,
+               in order of the last stage's score. name is the record id
+               of references added without a name
+    stages -- a list of StageStats, one per stage
+    seconds -- the total time taken"""
+
+    def __init__(self, matches, stages):
+        self.matches = matches
+        self.stages = stages
+        self.seconds = sum(stage.seconds for stage in stages)
+
+    @property
+    def names(self):
+        """Returns the names of the matching references."""
+        return [name for name, _ in self.matches]
+
+
+def _sample_digests(sample, algorithms):
+    digests = {}
+    for name in algorithms:
+        if isinstance(sample, dict):
+            digest = sample.get(name)
+        else:
+            try:
+                digest = fuzzyhashlib.new(name, buf=sample)
+            except ValueError:
+                digest = None
+        try:
+            if hasattr(digest, "hexdigest"):
+                digest = digest.hexdigest()
+        except ValueError:
+            digest = None
+        digests[name] = digest
+    return digests
+
+
+def _reference(record):
+    # Names are stored as TEXT, so can't be confused with integer ids.
+    return record.name if record.name is not None else record.id
+
+
+def _reference_records(db, reference):
+    if isinstance(reference, basestring):
+        return db.find(reference)
+    try:
+        return [db.get(reference)]
+    except KeyError:
+        return []
+
+
+def cascade_search(sample, db, stages=DEFAULT_STAGES):
+    """Returns a CascadeResult of the references in db (a DigestDB) which
+    match sample at every stage.
+
+    sample may be a buffer, or a dict of algorithm name to hash object or
+    hexdigest. stages is a list of (algorithm, threshold) pairs, where
+    threshold is as for DigestDB.search(). The first stage should be an
+    algorithm DigestDB can index (ie. ssdeep or tlsh)."""
+    if not stages:
+        raise ValueError("at least one stage is required")
+    digests = _sample_digests(sample, [name for name, _ in stages])
+    results = []
+
+    # Shortlist using the index.
+    name, threshold = stages[0]
+    start = time.time()
+    candidates, shortlist = {}, []
+    if digests[name] is not None:
+        shortlist = db.candidates(digests[name], threshold, name)
+        # Results are most similar first, so keep each reference's first
+        # score.
+        for record, score in db.search(digests[name], threshold, name,
+                                       shortlist):
+            candidates.setdefault(_reference(record), {name: score})
+    results.append(StageStats(name, threshold, len(shortlist),
+                              len(candidates), time.time() - start))
+
+    # Confirm the shortlist.
+    last = name
+    for name, threshold in stages[1:]:
+        start = time.time()
+        considered = len(candidates)
+        confirmed = {}
+        if digests[name] is not None and candidates:
+            records = [record for reference in candidates
+                       for record in _reference_records(db, reference)
+                       if record.algorithm == name]
+            # search() parses the sample once and reuses the DigestDB's
+            # parsed sdhash digests. Results are most similar first, so
+            # each reference's first score is its best.
+            for record, score in db.search(digests[name], threshold, name,
+                                           records):
+                reference = _reference(record)
+                if reference not in confirmed:
+                    candidates[reference][name] = score
+                    confirmed[reference] = candidates[reference]
+        candidates = confirmed
+        last = name
+        results.append(StageStats(name, threshold, considered,
+                                  len(candidates), time.time() - start))
+
+    matches = sorted(candidates.items(), key=lambda match: match[1][last],
+                     reverse=INDEXES[last].higher_is_better)
+    return CascadeResult(matches, results)
+
+
+class RecallReport(object):
+    """How a cascade compares with searching using only its last stage.
+
+    Attributes:
+
+    samples -- the number of samples searched for
+    recall -- the fraction of references found by the last stage alone
+              which were also found by the cascade
+    cascade_seconds -- the total time taken by cascade_search()
+    exhaustive_seconds -- the total time taken by the last stage alone
+    stages -- a list of StageStats totals for each stage"""
+
+    def __init__(self, samples, recall, cascade_seconds, exhaustive_seconds,
+                 stages):
+        self.samples = samples
+        self.recall = recall
+        self.cascade_seconds = cascade_seconds
+        self.exhaustive_seconds = exhaustive_seconds
+        self.stages = stages
+
+    @property
+    def speedup(self):
+        """Returns how many times faster the cascade was."""
+        if not self.cascade_seconds:
+            return 0.0
+        return self.exhaustive_seconds / self.cascade_seconds
+
+    def __repr__(self):
+        return "<RecallReport %d samples, recall %.3f, %.1fx faster>" % (
+            self.samples, self.recall, self.speedup)
+
+
+def cascade_recall(samples, db, stages=DEFAULT_STAGES):
+    """Returns a RecallReport of how well the cascade stages find, for each
+    sample in samples, the references which comparing with every reference
+    using only the last stage finds."""
+    name, threshold = stages[-1]
+    found = expected = 0
+    cascade_seconds = exhaustive_seconds = 0.0
+    totals = [StageStats(stage, limit, 0, 0, 0.0) for stage, limit in stages]
+    for sample in samples:
+        result = cascade_search(sample, db, stages)
+        cascade_seconds += result.seconds
+        for total, stats in zip(totals, result.stages):
+            total.candidates += stats.candidates
+            total.passed += stats.passed
+            total.seconds += stats.seconds
+
+        digest = _sample_digests(sample, [name])[name]
+        start = time.time()
+        exhaustive = set()
+        if digest is not None:
+            exhaustive = set(_reference(record) for record, _ in
+                             db.search(digest, threshold, name))
+        exhaustive_seconds += time.time() - start
+        expected += len(exhaustive)
+        found += len(exhaustive.intersection(result.names))
+    recall = float(found) / expected if expected else 1.0
+    return RecallReport(len(samples), recall, cascade_seconds,
+                        exhaustive_seconds, totals)
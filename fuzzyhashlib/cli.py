@@ -0,0 +1,439 @@
+from __future__ import print_function, absolute_import
+
+import argparse
+import codecs
+import csv
+import json
+import os
+import re
+import sys
+from multiprocessing import Pool, cpu_count
+
+import fuzzyhashlib
+from .index import new_index, DEFAULT_THRESHOLDS
+from .scancache import ScanCache, file_key
+from .stream import SDHASH_STREAM_LIMIT
+
+"""
+The fuzzyhashlib command line tool.
+
+Hashes files and directories with a pool of worker processes, printing
+digests in one of the following formats:
+
+    * native - the format of the algorithm's own tool (ssdeep, sdhash or
+      tlsh), which requires a single algorithm
+    * csv - a 'filename' column followed by a column per algorithm
+    * jsonl - one JSON object per file, keyed by 'filename' and algorithm.
+      Filenames which are not valid UTF-8 have each invalid byte written as
+      a lone surrogate (U+DC80 to U+DCFF), as Python 3's 'surrogateescape'
+      does, so that the original filename can be recovered
+
+In match mode (-m) inputs are compared against digests previously written
+in any of these formats, using fuzzyhashlib.index to avoid comparing each
+input with every known digest.
+
+With a scan cache (-c) files which have not changed since an earlier scan
+using the same cache are not read again (see fuzzyhashlib.scancache).
+
+sdhash must hold a whole file in memory, so files larger than the sdhash
+limit (-l, 64MB by default) are given no sdhash digest.
+
+[sptonkin@outlook.com]
+"""
+
+
+SSDEEP_HEADER = "ssdeep,1.1--blocksize:hash:hash,filename"
+
+
+def _surrogateescape(err):
+    if not isinstance(err, UnicodeDecodeError):
+        raise err
+    return (u"".join(unichr(0xdc00 + ord(byte))
+                     for byte in err.object[err.start:err.end]), err.end)
+
+codecs.register_error("fuzzyhashlib.surrogateescape", _surrogateescape)
+
+# Escaped bytes, but not the second half of a surrogate pair on narrow
+# builds.
+_ESCAPED = re.compile(u"((?<![\ud800-\udbff])[\udc80-\udcff]+)")
+
+
+def decode_path(path):
+    """Returns the unicode form of the byte string path used in JSON
+    output. Bytes which are not valid UTF-8 are mapped to U+DC80 to U+DCFF;
+    encode_path() reverses this."""
+    if isinstance(path, unicode):
+        return path
+    decoded = path.decode("utf-8", "fuzzyhashlib.surrogateescape")
+    if encode_path(decoded) != path:
+        # Python 2 decodes UTF-8 encoded surrogates, which would be
+        # ambiguous, so escape every non-ASCII byte instead.
+        decoded = u"".join(unichr(0xdc00 + ord(byte)) if byte >= "\x80"
+                           else unicode(byte) for byte in path)
+    return decoded
+
+
+def encode_path(path):
+    """Returns the byte string filename which decode_path() returned path
+    for."""
+    if not isinstance(path, unicode):
+        return path
+    return "".join("".join(chr(ord(char) - 0xdc00) for char in part)
+                   if i % 2 else part.encode("utf-8")
+                   for i, part in enumerate(_ESCAPED.split(path)))
+
+
+def iter_paths(paths, onerror=None):
+    """Yields every file named in paths, recursing into directories.
+    onerror is called with an OSError for each directory which cannot be
+    listed, as for os.walk()."""
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, files in os.walk(path, onerror=onerror):
+                dirs.sort()
+                for filename in sorted(files):
+                    yield os.path.join(root, filename)
+        else:
+            yield path
+
+
+def hash_file(path, algorithms, cache=None,
+              sdhash_limit=SDHASH_STREAM_LIMIT):
+    """Returns (path, digests, error) for the file at path, where digests
+    is a dict of algorithm name to hexdigest. Algorithms which cannot hash
+    the file (eg. because it is too small, or larger than sdhash_limit for
+    sdhash) map to None.
+
+    If cache (a ScanCache) is given, digests cached for the unchanged file
+    are used rather than reading it, and any others are added to it."""
+    digests, last_path, key, changed = {}, None, None, False
+    try:
+        if cache is not None:
+            key = file_key(os.stat(path))
+            digests, last_path = cache.get(key, algorithms)
+        missing = [name for name in algorithms if name not in digests]
+        if not missing:
+            if last_path != path:
+                cache.put(key, path, {})
+            return path, digests, None
+        with open(path, "rb") as f:
+            hashes = fuzzyhashlib.hash_stream(f, missing,
+                                              sdhash_limit=sdhash_limit)
+            if key is not None:
+                changed = file_key(os.fstat(f.fileno())) != key
+    except (IOError, OSError) as err:
+        return path, None, str(err)
+    hashed = dict((name, h and h.hexdigest()) for name, h in hashes.items())
+    # Digests of a file modified while being read are not cached, nor is
+    # the lack of a sdhash digest for a file over the limit.
+    if key is not None and not changed:
+        cached = dict(hashed)
+        if sdhash_limit is not None and key[2] > sdhash_limit and \
+                cached.get("sdhash", "") is None:
+            del cached["sdhash"]
+        cache.put(key, path, cached)
+    digests.update(hashed)
+    return path, digests, None
+
+
+def sdhash_with_name(digest, filename):
+    """Returns a sdhash digest with its name field set to filename, as the
+    sdhash tool prints. Returns (digest, name) of the original."""
+    magic, version, length, rest = digest.split(":", 3)
+    name, rest = rest[:int(length)], rest[int(length) + 1:]
+    named = "%s:%s:%d:%s:%s" % (magic, version, len(filename), filename, rest)
+    return named, name
+
+
+class Writer(object):
+    """Writes digests or matches to a stream in a given format. The
+    trailing newline of sdhash digests is removed so that every digest
+    fits on a single line. Native match output has a line per match, so
+    only native digest output requires a single algorithm."""
+
+    def __init__(self, stream, fmt, algorithms, match=False):
+        if fmt == "native" and not match and len(algorithms) != 1:
+            raise ValueError("native format requires a single algorithm")
+        self.stream = stream
+        self.fmt = fmt
+        self.algorithms = algorithms
+        self._csv = csv.writer(stream, lineterminator="\n")
+        self._header = False
+
+    def digests(self, path, digests):
+        digests = dict((name, digest and digest.rstrip("\n"))
+                       for name, digest in digests.items())
+        if self.fmt == "jsonl":
+            record = dict(digests, filename=decode_path(path))
+            self.stream.write(json.dumps(record, sort_keys=True) + "\n")
+        elif self.fmt == "csv":
+            if not self._header:
+                self._csv.writerow(["filename"] + self.algorithms)
+                self._header = True
+            self._csv.writerow([path] + [digests[name] or ""
+                                         for name in self.algorithms])
+        else:
+            name = self.algorithms[0]
+            digest = digests[name]
+            if digest is None:
+                return
+            if name == "ssdeep":
+                if not self._header:
+                    self.stream.write(SSDEEP_HEADER + "\n")
+                    self._header = True
+                self.stream.write('%s,"%s"\n' % (digest, path))
+            elif name == "sdhash":
+                self.stream.write(sdhash_with_name(digest, path)[0] + "\n")
+            else:
+                self.stream.write("%s\t%s\n" % (digest, path))
+
+    def match(self, path, name, key, score):
+        if self.fmt == "jsonl":
+            record = {"filename": decode_path(path), "algorithm": name,
+                      "match": decode_path(key), "score": score}
+            self.stream.write(json.dumps(record, sort_keys=True) + "\n")
+        elif self.fmt == "csv":
+            if not self._header:
+                self._csv.writerow(["filename", "algorithm", "match",
+                                    "score"])
+                self._header = True
+            self._csv.writerow([path, name, key, score])
+        else:
+            self.stream.write("%s matches %s (%s)\n" % (path, key, score))
+
+
+def read_digests(stream):
+    """Yields (filename, algorithm, digest) for each digest in stream,
+    which may be in any format written by this tool. sdhash digests are
+    returned as hexdigest() would return them."""
+    for filename, name, digest in _read_digests(stream):
+        if name == "sdhash":
+            digest = digest.rstrip("\n") + "\n"
+        yield filename, name, digest
+
+
+def detect_format(line):
+    """Returns the format ("jsonl", "csv", "ssdeep", "sdhash" or "tlsh") of
+    a digest file from its first line."""
+    if line.startswith("{"):
+        return "jsonl"
+    elif line == SSDEEP_HEADER:
+        return "ssdeep"
+    elif line.startswith("filename,"):
+        return "csv"
+    elif line.startswith("sdbf:"):
+        return "sdhash"
+    elif "\t" in line:
+        return "tlsh"
+    return "ssdeep"
+
+
+def _read_digests(stream):
+    # The format is detected once, so that filenames in later lines (eg.
+    # 'filename,1') can't be mistaken for a header.
+    fmt = header = None
+    for line in stream:
+        line = line.rstrip("\r\n")
+        if not line:
+            continue
+        if fmt is None:
+            fmt = detect_format(line)
+            if fmt == "csv":
+                header = next(csv.reader([line]))
+                continue
+        if fmt == "jsonl":
+            record = json.loads(line)
+            for name in fuzzyhashlib.algorithms_available:
+                if record.get(name):
+                    yield (encode_path(record["filename"]), name,
+                           str(record[name]))
+        elif fmt == "csv":
+            row = next(csv.reader([line]))
+            for name, digest in zip(header[1:], row[1:]):
+                if digest:
+                    yield row[0], name, digest
+        elif fmt == "sdhash":
+            digest, filename = sdhash_with_name(line, "")
+            yield filename, "sdhash", digest
+        elif fmt == "tlsh":
+            digest, filename = line.split("\t", 1)
+            yield filename, "tlsh", digest
+        elif line != SSDEEP_HEADER:
+            digest, filename = line.split(",", 1)
+            yield filename.strip('"'), "ssdeep", digest
+
+
+def load_indexes(paths, algorithms):
+    """Returns a dict of algorithm name to index holding every digest in
+    the files named in paths."""
+    indexes = dict((name, new_index(name)) for name in algorithms)
+    for path in paths:
+        with open(path) as stream:
+            for filename, name, digest in read_digests(stream):
+                if name in indexes:
+                    indexes[name].add("%s:%s" % (path, filename), digest)
+    return indexes
+
+
+# Worker process state, set by _init_worker().
+_algorithms = None
+_indexes = None
+_thresholds = None
+_cache = None
+_sdhash_limit = SDHASH_STREAM_LIMIT
+
+
+def _init_worker(algorithms, indexes, thresholds, cache_path, sdhash_limit):
+    global _algorithms, _indexes, _thresholds, _cache, _sdhash_limit
+    _algorithms = algorithms
+    _indexes = indexes
+    _thresholds = thresholds
+    _sdhash_limit = sdhash_limit
+    # Each worker has its own connection; they cannot be shared by forking.
+    _cache = ScanCache(cache_path) if cache_path else None
+
+
+def _hash_worker(path):
+    return hash_file(path, _algorithms, _cache, _sdhash_limit)
+
+
+def _match_worker(path):
+    path, digests, error = hash_file(path, _algorithms, _cache,
+                                     _sdhash_limit)
+    if error is not None:
+        return path, None, error
+    matches = []
+    for name in _algorithms:
+        if digests[name] is not None:
+            for key, score in _indexes[name].search(digests[name],
+                                                    _thresholds[name]):
+                matches.append((name, key, score))
+    return path, matches, None
+
+
+def parse_thresholds(value, algorithms):
+    """Returns a dict of algorithm name to threshold for each of algorithms
+    from value, a comma separated list of NAME=THRESHOLD. A bare THRESHOLD
+    may be given when there is a single algorithm. Raises ValueError if
+    value is invalid."""
+    thresholds = dict((name, DEFAULT_THRESHOLDS[name]) for name in algorithms)
+    if value is None:
+        return thresholds
+    for item in value.split(","):
+        name, sep, threshold = item.rpartition("=")
+        if not sep:
+            if len(algorithms) != 1:
+                raise ValueError("threshold %s must be given as NAME=%s as "
+                                 "there is more than one algorithm" %
+                                 (threshold, threshold))
+            name = algorithms[0]
+        if name not in algorithms:
+            raise ValueError("threshold given for unused algorithm %s" % name)
+        try:
+            thresholds[name] = int(threshold)
+        except ValueError:
+            raise ValueError("invalid threshold %r" % item)
+    return thresholds
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(
+        prog="fuzzyhashlib",
+        description="Compute and match fuzzy hashes of files.")
+    parser.add_argument("paths", nargs="+", metavar="PATH",
+                        help="files or directories to hash")
+    parser.add_argument("-a", "--algorithms", default="ssdeep",
+                        help="comma separated algorithms to use, from %s "
+                             "(default: ssdeep)" %
+                             ",".join(fuzzyhashlib.algorithms_available))
+    parser.add_argument("-c", "--cache", metavar="CACHE",
+                        help="reuse digests of files unchanged since they "
+                             "were stored in, and store new digests in, the "
+                             "scan cache CACHE")
+    parser.add_argument("-f", "--format", default="native",
+                        choices=("native", "csv", "jsonl"),
+                        help="output format (default: native)")
+    parser.add_argument("-j", "--jobs", type=int, default=cpu_count(),
+                        help="worker processes (default: number of CPUs)")
+    parser.add_argument("-l", "--sdhash-limit", type=int, metavar="MB",
+                        default=SDHASH_STREAM_LIMIT // (1024 * 1024),
+                        help="largest file, in megabytes, to hash with "
+                             "sdhash, which holds the whole file in memory; "
+                             "0 for no limit (default: %(default)s)")
+    parser.add_argument("-m", "--match", action="append", metavar="DB",
+                        help="match inputs against digests in DB; may be "
+                             "given more than once")
+    parser.add_argument("-t", "--threshold", metavar="NAME=THRESHOLD,...",
+                        help="comma separated minimum scores to report per "
+                             "algorithm (maximum distance for tlsh), eg. "
+                             "ssdeep=30,tlsh=50; a bare number may be given "
+                             "with a single algorithm. Defaults to %s" %
+                             ",".join("%s=%d" % item for item in
+                                      sorted(DEFAULT_THRESHOLDS.items())))
+    return parser
+
+
+def main(argv=None, stdout=None, stderr=None):
+    stdout = stdout or sys.stdout
+    stderr = stderr or sys.stderr
+    args = build_parser().parse_args(argv)
+
+    algorithms = args.algorithms.split(",")
+    for name in algorithms:
+        if name not in fuzzyhashlib.algorithms_available:
+            print("fuzzyhashlib: unsupported hash type %s" % name,
+                  file=stderr)
+            return 2
+    if args.sdhash_limit < 0:
+        print("fuzzyhashlib: sdhash limit must not be negative", file=stderr)
+        return 2
+    try:
+        writer = Writer(stdout, args.format, algorithms, bool(args.match))
+        thresholds = parse_thresholds(args.threshold, algorithms)
+    except ValueError as err:
+        print("fuzzyhashlib: %s" % err, file=stderr)
+        return 2
+
+    if args.match:
+        indexes = load_indexes(args.match, algorithms)
+        worker = _match_worker
+    else:
+        indexes = thresholds = None
+        worker = _hash_worker
+
+    sdhash_limit = args.sdhash_limit * 1024 * 1024 or None
+
+    # Directories are walked by the pool's task handler thread.
+    errors = []
+
+    def walk_error(err):
+        print("fuzzyhashlib: %s: %s" % (err.filename, err.strerror),
+              file=stderr)
+        errors.append(err)
+
+    # Worker state is inherited by forked processes rather than pickled.
+    status = 0
+    pool = Pool(args.jobs, _init_worker,
+                (algorithms, indexes, thresholds, args.cache, sdhash_limit))
+    try:
+        for path, result, error in pool.imap(
+                worker, iter_paths(args.paths, walk_error), 16):
+            if error is not None:
+                print("fuzzyhashlib: %s: %s" % (path, error), file=stderr)
+                status = 1
+            elif args.match:
+                for name, key, score in result:
+                    writer.match(path, name, key, score)
+            else:
+                writer.digests(path, result)
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+    if errors:
+        status = 1
+    return status
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,296 @@
+from __future__ import print_function, absolute_import
+
+import json
+import sqlite3
+
+import fuzzyhashlib
+from .index import INDEXES, DEFAULT_THRESHOLDS, ssdeep_grams, parse_tlsh, \
+    tlsh_lvalues, tlsh_header_diff
+
+"""
+A persistent similarity database of fuzzy hashes, stored in SQLite.
+
+Alongside each digest the tables used by fuzzyhashlib.index to find
+candidates are kept up to date as digests are added and removed, so that
+searching is an indexed query followed by a short list of compares:
+
+    * ssdeep - a row per (effective block size, 7-gram) of each digest
+    * tlsh - a row per digest keyed by its length value, which is checked
+      against the rest of the header before comparing
+    * sdhash - no index; every sdhash digest is compared. Parsed sdhash
+      digests are kept by the DigestDB after the first sdhash search, so
+      later searches parse only digests added since
+
+The database is opened in SQLite's WAL mode, so any number of processes
+may search while another adds or removes digests.
+
+[sptonkin@outlook.com]
+"""
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS digests (
+    id INTEGER PRIMARY KEY,
+    algorithm TEXT NOT NULL,
+    digest TEXT NOT NULL,
+    name TEXT,
+    metadata TEXT
+);
+CREATE INDEX IF NOT EXISTS digests_digest ON digests (algorithm, digest);
+CREATE INDEX IF NOT EXISTS digests_name ON digests (name);
+CREATE TABLE IF NOT EXISTS ssdeep_grams (
+    gram TEXT NOT NULL,
+    digest_id INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS ssdeep_grams_gram ON ssdeep_grams (gram);
+CREATE INDEX IF NOT EXISTS ssdeep_grams_digest_id
+    ON ssdeep_grams (digest_id);
+CREATE TABLE IF NOT EXISTS tlsh_lengths (
+    digest_id INTEGER PRIMARY KEY,
+    lvalue INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS tlsh_lengths_lvalue ON tlsh_lengths (lvalue);
+"""
+
+# SQLite's default limit on the number of parameters in a statement.
+MAX_PARAMETERS = 999
+
+
+class Record(object):
+    """A digest stored in a DigestDB.
+
+    Attributes:
+
+    id -- the digest's row id
+    algorithm -- the name of the algorithm (eg. "ssdeep")
+    digest -- the digest, as returned by hexdigest()
+    name -- the name given when the digest was added (eg. a filename)
+    metadata -- the JSON serialisable metadata given when it was added"""
+
+    __slots__ = ("id", "algorithm", "digest", "name", "metadata")
+
+    def __init__(self, id, algorithm, digest, name, metadata):
+        self.id = id
+        self.algorithm = algorithm
+        self.digest = digest
+        self.name = name
+        self.metadata = json.loads(metadata) if metadata else None
+
+    def __repr__(self):
+        return "<Record %d %s %r>" % (self.id, self.algorithm, self.name)
+
+
+class DigestDB(object):
+    """A SQLite backed database of ssdeep, sdhash and tlsh digests.
+
+    Methods:
+
+    add() -- stores a digest, returning its id
+    remove() -- removes a digest by id
+    get() -- returns the Record with a given id
+    find() -- returns the Records with a given name
+    candidates() -- returns the Records the index selects for a digest
+    search() -- returns (Record, score) pairs similar to a digest
+    count() -- returns the number of digests stored
+    close() -- closes the database"""
+
+    def __init__(self, path, timeout=30.0):
+        """Opens (creating if needed) the database at path. timeout is the
+        number of seconds to wait for another writer to finish."""
+        self.path = path
+        self._conn = sqlite3.connect(path, timeout=timeout)
+        # Digests are passed to the native compare functions as strings.
+        self._conn.text_factory = str
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        with self._conn:
+            self._conn.executescript(SCHEMA)
+        # Parsed sdhash objects by digest, see _sdhash_digests().
+        self._sdhashes = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __len__(self):
+        return self._conn.execute("SELECT COUNT(*) FROM digests").fetchone()[0]
+
+    def count(self, algorithm=None):
+        """Returns the number of digests stored, optionally only those of
+        the algorithm called algorithm."""
+        if algorithm is None:
+            return len(self)
+        return self._conn.execute(
+            "SELECT COUNT(*) FROM digests WHERE algorithm = ?",
+            (algorithm,)).fetchone()[0]
+
+    def close(self):
+        self._conn.close()
+
+    def add(self, digest, name=None, metadata=None, algorithm=None):
+        """Stores digest, which may be a hash object or the hexdigest() of
+        one. algorithm must be given if digest is a string. metadata may be
+        any JSON serialisable value. Returns the id of the new record."""
+        algorithm, digest = _digest(digest, algorithm)
+        if metadata is not None:
+            metadata = json.dumps(metadata, sort_keys=True)
+        with self._conn:
+            cursor = self._conn.execute(
+                "INSERT INTO digests (algorithm, digest, name, metadata) "
+                "VALUES (?, ?, ?, ?)", (algorithm, digest, name, metadata))
+            digest_id = cursor.lastrowid
+            if algorithm == "ssdeep":
+                self._conn.executemany(
+                    "INSERT INTO ssdeep_grams (gram, digest_id) VALUES (?, ?)",
+                    [(_gram_key(gram), digest_id)
+                     for gram in ssdeep_grams(digest)])
+            elif algorithm == "tlsh":
+                self._conn.execute(
+                    "INSERT INTO tlsh_lengths (digest_id, lvalue) "
+                    "VALUES (?, ?)", (digest_id, parse_tlsh(digest)[1]))
+        return digest_id
+
+    def remove(self, digest_id):
+        """Removes the record with id digest_id. Raises KeyError if there
+        is no such record."""
+        with self._conn:
+            row = self._conn.execute(
+                "SELECT algorithm, digest FROM digests WHERE id = ?",
+                (digest_id,)).fetchone()
+            if row is None:
+                raise KeyError(digest_id)
+            self._conn.execute("DELETE FROM digests WHERE id = ?",
+                               (digest_id,))
+            if row[0] == "sdhash" and not self._conn.execute(
+                    "SELECT 1 FROM digests WHERE algorithm = ? AND "
+                    "digest = ?", row).fetchone():
+                self._sdhashes.pop(row[1], None)
+            self._conn.execute("DELETE FROM ssdeep_grams WHERE digest_id = ?",
+                               (digest_id,))
+            self._conn.execute("DELETE FROM tlsh_lengths WHERE digest_id = ?",
+                               (digest_id,))
+
+    def get(self, digest_id):
+        """Returns the Record with id digest_id. Raises KeyError if there
+        is no such record."""
+        records = self._records("id = ?", [digest_id])
+        if not records:
+            raise KeyError(digest_id)
+        return records[0]
+
+    def find(self, name):
+        """Returns a list of Records added with name."""
+        return self._records("name = ?", [name])
+
+    def candidates(self, digest, threshold=None, algorithm=None):
+        """Returns a list of the Records which search() would compare with
+        digest, ie. those the index cannot rule out matching at threshold.
+        Arguments are as for search()."""
+        algorithm, digest = _digest(digest, algorithm)
+        if threshold is None:
+            threshold = DEFAULT_THRESHOLDS[algorithm]
+        return self._candidates(algorithm, digest, threshold)
+
+    def search(self, digest, threshold=None, algorithm=None,
+               candidates=None):
+        """Returns a list of (Record, score) pairs for stored digests which
+        match digest at threshold, most similar first. digest may be a hash
+        object or the hexdigest() of one, in which case algorithm must be
+        given. threshold is a minimum score for ssdeep and sdhash and a
+        maximum distance for tlsh, and defaults to DEFAULT_THRESHOLDS.
+        candidates may be the result of an earlier call to candidates() with
+        the same arguments, to save selecting them again.
+
+        sdhash searches are not indexed: every stored sdhash digest is
+        compared, and is parsed the first time it is searched. The parsed
+        digests are kept in memory for later searches."""
+        algorithm, digest = _digest(digest, algorithm)
+        if threshold is None:
+            threshold = DEFAULT_THRESHOLDS[algorithm]
+        index = INDEXES[algorithm]()
+        complete = candidates is None
+        if complete:
+            candidates = self._candidates(algorithm, digest, threshold)
+        compare = index.score
+        if algorithm == "sdhash":
+            parsed = self._sdhash_digests(candidates, complete)
+            query = fuzzyhashlib.sdhash(hash=digest)
+            compare = lambda _, other: query.compare(parsed[other])
+        matches = []
+        for record in candidates:
+            score = compare(digest, record.digest)
+            if index.matches(score, threshold):
+                matches.append((record, score))
+        matches.sort(key=lambda match: match[1],
+                     reverse=index.higher_is_better)
+        return matches
+
+    def _candidates(self, algorithm, digest, threshold):
+        if algorithm == "ssdeep":
+            keys = [_gram_key(gram) for gram in ssdeep_grams(digest)]
+            ids = set(row[0] for row in self._conn.execute(
+                "SELECT id FROM digests WHERE algorithm = ? AND digest = ?",
+                (algorithm, digest)))
+            ids.update(self._select_in(
+                "SELECT DISTINCT digest_id FROM ssdeep_grams WHERE gram IN (%s)",
+                keys))
+            return self._records("id IN (%s)", sorted(ids))
+        elif algorithm == "tlsh":
+            header = parse_tlsh(digest)
+            ids = self._select_in(
+                "SELECT digest_id FROM tlsh_lengths WHERE lvalue IN (%s)",
+                tlsh_lvalues(header[1], threshold))
+            return [record for record in self._records("id IN (%s)", ids)
+                    if tlsh_header_diff(header, parse_tlsh(record.digest))
+                    <= threshold]
+        else:
+            return self._records("algorithm = ?", [algorithm])
+
+    def _sdhash_digests(self, records, complete=False):
+        # Returns a dict of digest to parsed sdhash for records, reusing
+        # those parsed by earlier searches and keeping any new ones. If
+        # records is every stored sdhash digest (complete), digests which
+        # are no longer stored (eg. removed by another process) are dropped.
+        parsed = {}
+        for record in records:
+            if record.digest not in parsed:
+                parsed[record.digest] = self._sdhashes.get(record.digest) or \
+                    fuzzyhashlib.sdhash(hash=record.digest)
+        if complete:
+            self._sdhashes = parsed
+        else:
+            self._sdhashes.update(parsed)
+        return parsed
+
+    def _select_in(self, sql, values):
+        results = []
+        for i in range(0, len(values), MAX_PARAMETERS):
+            chunk = values[i:i + MAX_PARAMETERS]
+            results.extend(row[0] for row in self._conn.execute(
+                sql % ",".join("?" * len(chunk)), chunk))
+        return results
+
+    def _records(self, where, values):
+        sql = "SELECT id, algorithm, digest, name, metadata FROM digests " \
+              "WHERE " + where
+        if "%s" not in where:
+            return [Record(*row) for row in self._conn.execute(sql, values)]
+        records = []
+        for i in range(0, len(values), MAX_PARAMETERS):
+            chunk = values[i:i + MAX_PARAMETERS]
+            records.extend(Record(*row) for row in self._conn.execute(
+                sql % ",".join("?" * len(chunk)), chunk))
+        return records
+
+
+def _gram_key(gram):
+    return "%d:%s" % gram
+
+
+def _digest(digest, algorithm):
+    if hasattr(digest, "hexdigest"):
+        return digest.name, digest.hexdigest()
+    if algorithm not in INDEXES:
+        raise ValueError("algorithm must be given for digest %r" % digest)
+    return algorithm, digest
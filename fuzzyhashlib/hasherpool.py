@@ -0,0 +1,97 @@
+from __future__ import print_function, absolute_import
+
+import threading
+from contextlib import contextmanager
+
+import fuzzyhashlib
+from . import tlsh_wrapper
+
+"""
+A pool of reusable hash objects.
+
+Creating a hash object allocates native state which is freed again when the
+object is garbage collected. When hashing many small inputs that cost can
+outweigh the hashing itself, so a HasherPool keeps a few objects and
+reset()s them for each new input instead.
+
+ssdeep objects reuse their fuzzy_state. A Tlsh cannot be reused once it
+has been updated, so a pooled tlsh object would still need a new Tlsh for
+each input; a tlsh HasherPool therefore only offers hexdigest(), which
+uses the extension's hash() function. sdhash objects cannot be updated and
+so cannot be pooled.
+
+[sptonkin@outlook.com]
+"""
+
+
+class HasherPool(object):
+    """A thread-safe pool of hash objects of one algorithm.
+
+    Methods:
+
+    acquire() -- returns an empty hash object, ready to be updated
+    release() -- returns a hash object to the pool for reuse
+    hasher() -- a context manager acquiring and releasing a hash object
+    hexdigest() -- returns the digest of a buffer using a pooled object
+
+    acquire() and hasher() raise InvalidOperation for tlsh, whose objects
+    cannot be reused.
+
+    Attributes:
+
+    name -- the name of the algorithm of the pooled objects
+    size -- the maximum number of idle objects kept in the pool"""
+
+    def __init__(self, name="ssdeep", size=4):
+        if name not in ("ssdeep", "tlsh"):
+            raise ValueError("unsupported hash type %s" % name)
+        self.name = name
+        self.size = size
+        self._cls = getattr(fuzzyhashlib, name)
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        """Returns the number of idle objects in the pool."""
+        return len(self._idle)
+
+    def acquire(self):
+        """Returns an empty hash object, reusing an idle one if possible."""
+        if self.name == "tlsh":
+            raise fuzzyhashlib.InvalidOperation(
+                "tlsh objects cannot be reused, use hexdigest()")
+        with self._lock:
+            if self._idle:
+                return self._idle.pop()
+        return self._cls(buf="")
+
+    def release(self, h):
+        """Resets h and returns it to the pool, unless the pool is full. h
+        must not be used by the caller afterwards."""
+        h.reset()
+        with self._lock:
+            if len(self._idle) < self.size:
+                self._idle.append(h)
+
+    @contextmanager
+    def hasher(self):
+        """Returns a context manager giving a hash object from the pool,
+        which is released when the context exits."""
+        h = self.acquire()
+        try:
+            yield h
+        finally:
+            self.release(h)
+
+    def hexdigest(self, buf):
+        """Returns the digest of buf. Raises ValueError if the algorithm
+        cannot hash buf."""
+        if self.name == "tlsh":
+            digest = tlsh_wrapper.hash(buf)
+            if not digest:
+                raise ValueError("tlsh cannot hash buffer of length %d"
+                                 % len(buf))
+            return digest
+        with self.hasher() as h:
+            h.update(buf)
+            return h.hexdigest()
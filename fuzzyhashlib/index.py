@@ -0,0 +1,416 @@
+from __future__ import print_function, absolute_import
+
+import heapq
+
+import fuzzyhashlib
+from . import libssdeep_wrapper
+from . import tlsh_wrapper
+
+"""
+In-memory indexes for finding similar digests without comparing a digest
+against every other digest.
+
+Each index generates a short list of candidates for a query digest, which
+are then confirmed using the algorithm's own comparison function:
+
+    * ssdeep - exact. fuzzy_compare() only scores two digests above zero
+      if they are identical, or if chunks of the same effective block size
+      share a 7 character substring, so candidates are found by indexing
+      chunks by block size and 7-grams.
+    * tlsh - exact. diff() adds the distance between the digests' headers
+      (checksum, length and quartile ratios) to the distance between their
+      bodies, so the header distance is a lower bound on diff(). Digests
+      are grouped by length and only groups, then digests, whose header
+      distance is within the threshold are candidates.
+    * sdhash - none. Every digest is a candidate, although digests are only
+      parsed once.
+
+The ssdeep and tlsh indexes can also return the k digests most similar to
+a query (top_k()). ssdeep only compares the candidates, and tlsh visits
+digests grouped by header in order of header distance, stopping once the
+header distance alone is more than the k'th best diff() found so far.
+
+[sptonkin@outlook.com]
+"""
+
+
+# From ssdeep's fuzzy.c.
+ROLLING_WINDOW = 7
+
+# Thresholds used when none are given; scores for ssdeep and sdhash,
+# distances for tlsh.
+DEFAULT_THRESHOLDS = {
+    "ssdeep": 1,
+    "sdhash": 1,
+    "tlsh": 30,
+}
+
+
+def parse_ssdeep(digest):
+    """Returns the (block_size, chunk, double_chunk) parts of a ssdeep
+    digest. Any trailing ',filename' is ignored."""
+    try:
+        block_size, chunk, double_chunk = digest.split(",", 1)[0].split(":")
+        return int(block_size), chunk, double_chunk
+    except ValueError:
+        raise ValueError("invalid ssdeep digest %r" % digest)
+
+
+def eliminate_sequences(chunk):
+    """Returns chunk with runs of more than three identical characters
+    shortened to three, as fuzzy_compare() does before scoring."""
+    result = chunk[:3]
+    for i in range(3, len(chunk)):
+        c = chunk[i]
+        if c != chunk[i - 1] or c != chunk[i - 2] or c != chunk[i - 3]:
+            result += c
+    return result
+
+
+def ssdeep_grams(digest):
+    """Returns the set of (effective_block_size, 7-gram) keys of a ssdeep
+    digest. Two digests can only have a non-zero score if they share a key
+    or are identical."""
+    block_size, chunk, double_chunk = parse_ssdeep(digest)
+    grams = set()
+    for size, part in ((block_size, chunk), (block_size * 2, double_chunk)):
+        part = eliminate_sequences(part)
+        for i in range(len(part) - ROLLING_WINDOW + 1):
+            grams.add((size, part[i:i + ROLLING_WINDOW]))
+    return grams
+
+
+def _swap(hex_byte):
+    # tlsh writes each header byte with its nibbles swapped.
+    return int(hex_byte[1] + hex_byte[0], 16)
+
+
+def _mod_diff(x, y, r):
+    d = abs(x - y)
+    return min(d, r - d)
+
+
+def parse_tlsh(digest):
+    """Returns the (checksum, lvalue, q1ratio, q2ratio, body) parts of a tlsh
+    digest."""
+    checksum_len = len(digest) - 68
+    if checksum_len < 2 or checksum_len % 2:
+        raise ValueError("invalid tlsh digest %r" % digest)
+    checksum = digest[:checksum_len]
+    lvalue = _swap(digest[checksum_len:checksum_len + 2])
+    q = _swap(digest[checksum_len + 2:checksum_len + 4])
+    return checksum, lvalue, q & 0x0F, q >> 4, digest[checksum_len + 4:]
+
+
+def tlsh_length_diff(lvalue1, lvalue2):
+    """Returns the contribution of the two length values to diff()."""
+    ldiff = _mod_diff(lvalue1, lvalue2, 256)
+    if ldiff <= 1:
+        return ldiff
+    return ldiff * 12
+
+
+def tlsh_lvalues(lvalue, threshold):
+    """Returns the length values whose contribution to diff() with lvalue
+    is <= threshold."""
+    if threshold < 1:
+        limit = 0
+    elif threshold < 24:
+        limit = 1
+    else:
+        limit = min(threshold // 12, 128)
+    return sorted(set((lvalue + d) % 256 for d in range(-limit, limit + 1)))
+
+
+def tlsh_header_diff(a, b):
+    """Returns the distance between the headers of the parsed tlsh digests
+    a and b (see parse_tlsh()), which is a lower bound on diff()."""
+    diff = tlsh_length_diff(a[1], b[1])
+    for q1, q2 in ((a[2], b[2]), (a[3], b[3])):
+        qdiff = _mod_diff(q1, q2, 16)
+        diff += qdiff if qdiff <= 1 else (qdiff - 1) * 12
+    if a[0] != b[0]:
+        diff += 1
+    return diff
+
+
+class _Index(object):
+    """Base index. Keys are arbitrary hashable values (eg. filenames) and
+    each key has exactly one digest."""
+
+    name = None
+
+    def __init__(self):
+        self._digests = {}
+
+    def __len__(self):
+        return len(self._digests)
+
+    def __contains__(self, key):
+        return key in self._digests
+
+    def digest(self, key):
+        """Returns the digest stored for key."""
+        return self._digests[key]
+
+    def add(self, key, digest):
+        """Adds digest to the index under key, replacing any digest
+        previously stored under key."""
+        if key in self._digests:
+            self.remove(key)
+        self._digests[key] = digest
+        self._add(key, digest)
+
+    def remove(self, key):
+        """Removes key from the index. Raises KeyError if key is unknown."""
+        digest = self._digests.pop(key)
+        self._remove(key, digest)
+
+    def search(self, digest, threshold):
+        """Returns a list of (key, score) pairs for stored digests which
+        match digest at threshold, most similar first."""
+        matches = []
+        for key in self.candidates(digest, threshold):
+            score = self.score(digest, self._digests[key])
+            if self.matches(score, threshold):
+                matches.append((key, score))
+        matches.sort(key=lambda match: match[1], reverse=self.higher_is_better)
+        return matches
+
+    def _add(self, key, digest):
+        pass
+
+    def _remove(self, key, digest):
+        pass
+
+
+class SsdeepIndex(_Index):
+    """Index of ssdeep digests. Scores are fuzzy_compare() scores and
+    search() returns digests scoring >= threshold."""
+
+    name = "ssdeep"
+    higher_is_better = True
+
+    def __init__(self):
+        super(SsdeepIndex, self).__init__()
+        self._grams = {}
+        self._exact = {}
+
+    def _add(self, key, digest):
+        self._exact.setdefault(digest, set()).add(key)
+        for gram in ssdeep_grams(digest):
+            self._grams.setdefault(gram, set()).add(key)
+
+    def _remove(self, key, digest):
+        _discard(self._exact, digest, key)
+        for gram in ssdeep_grams(digest):
+            _discard(self._grams, gram, key)
+
+    def candidates(self, digest, threshold=None):
+        """Returns the set of keys whose digests may score above zero."""
+        keys = set(self._exact.get(digest, ()))
+        for gram in ssdeep_grams(digest):
+            keys.update(self._grams.get(gram, ()))
+        return keys
+
+    def top_k(self, digest, k):
+        """Returns a list of (key, score) for the k stored digests scoring
+        highest against digest, best first. Ties are broken by key and
+        digests scoring 0 are not returned."""
+        scores = []
+        for key in self.candidates(digest):
+            score = self.score(digest, self._digests[key])
+            if score > 0:
+                scores.append((-score, key))
+        return [(key, -score) for score, key in heapq.nsmallest(k, scores)]
+
+    @staticmethod
+    def score(a, b):
+        return libssdeep_wrapper.compare(a, b)
+
+    @staticmethod
+    def matches(score, threshold):
+        return score > 0 and score >= threshold
+
+
+class TlshIndex(_Index):
+    """Index of tlsh digests. Scores are diff() distances and search()
+    returns digests with a distance <= threshold."""
+
+    name = "tlsh"
+    higher_is_better = False
+
+    def __init__(self):
+        super(TlshIndex, self).__init__()
+        self._lengths = {}
+        self._headers = {}
+        # Keys by length value, then by quartile ratios.
+        self._ratios = {}
+
+    def _add(self, key, digest):
+        header = parse_tlsh(digest)
+        self._headers[key] = header
+        self._lengths.setdefault(header[1], set()).add(key)
+        self._ratios.setdefault(header[1], {}).setdefault(
+            header[2:4], set()).add(key)
+
+    def _remove(self, key, digest):
+        header = self._headers.pop(key)
+        _discard(self._lengths, header[1], key)
+        _discard(self._ratios[header[1]], header[2:4], key)
+        if not self._ratios[header[1]]:
+            del self._ratios[header[1]]
+
+    def candidates(self, digest, threshold=None):
+        """Returns the set of keys whose digests' headers are within
+        threshold of digest's header. All keys are returned if threshold
+        is None."""
+        if threshold is None:
+            return set(self._digests)
+        header = parse_tlsh(digest)
+        keys = set()
+        for lvalue in tlsh_lvalues(header[1], threshold):
+            for key in self._lengths.get(lvalue, ()):
+                if tlsh_header_diff(header, self._headers[key]) <= threshold:
+                    keys.add(key)
+        return keys
+
+    def top_k(self, digest, k):
+        """Returns a list of (key, distance) for the k stored digests
+        closest to digest, closest first. Ties are broken by key."""
+        if k < 1:
+            return []
+        header = parse_tlsh(digest)
+        # Negated distances of the closest k so far, the furthest on top.
+        closest = []
+        scores = []
+        lengths = sorted((tlsh_length_diff(header[1], lvalue), lvalue)
+                         for lvalue in self._ratios)
+        for length_diff, lvalue in lengths:
+            if len(closest) == k and length_diff > -closest[0]:
+                break
+            for (q1, q2), keys in self._ratios[lvalue].items():
+                # The header distance of the group, ignoring checksums.
+                bound = tlsh_header_diff(header, (header[0], lvalue, q1, q2))
+                if len(closest) == k and bound > -closest[0]:
+                    continue
+                for key in keys:
+                    score = self.score(digest, self._digests[key])
+                    scores.append((score, key))
+                    if len(closest) < k:
+                        heapq.heappush(closest, -score)
+                    elif score < -closest[0]:
+                        heapq.heapreplace(closest, -score)
+        return [(key, score) for score, key in heapq.nsmallest(k, scores)]
+
+    @staticmethod
+    def score(a, b):
+        return tlsh_wrapper.diff(a, b)
+
+    @staticmethod
+    def matches(score, threshold):
+        return score <= threshold
+
+
+class SdhashIndex(_Index):
+    """Index of sdhash digests. Scores are sdbf compare() scores and
+    search() returns digests scoring >= threshold."""
+
+    name = "sdhash"
+    higher_is_better = True
+
+    def __init__(self):
+        super(SdhashIndex, self).__init__()
+        self._parsed = {}
+
+    def _parse(self, digest):
+        parsed = self._parsed.get(digest)
+        if parsed is None:
+            parsed = fuzzyhashlib.sdhash(hash=digest)
+        return parsed
+
+    def _add(self, key, digest):
+        self._parsed[digest] = self._parse(digest)
+
+    def _remove(self, key, digest):
+        if digest not in self._digests.values():
+            del self._parsed[digest]
+
+    def candidates(self, digest, threshold=None):
+        """Returns every key in the index."""
+        return set(self._digests)
+
+    def score(self, a, b):
+        return self._parse(a).compare(self._parse(b))
+
+    @staticmethod
+    def matches(score, threshold):
+        return score > 0 and score >= threshold
+
+
+def top_k(query, candidates, k, name=None):
+    """Returns a list of (key, score) for the k candidates most similar to
+    query, most similar first, as for SsdeepIndex.top_k() and
+    TlshIndex.top_k().
+
+    candidates may be a SsdeepIndex or TlshIndex, or a list of hash objects
+    or digests whose keys are their positions in the list. query may be a
+    hash object or a digest, in which case name must be given, of either
+    "ssdeep" or "tlsh".
+
+    Searching an index is much faster when it is queried many times, as
+    candidate digests are only parsed when added. For a list, only ssdeep
+    digests with compatible block sizes are compared."""
+    name = getattr(query, "name", name)
+    if hasattr(query, "hexdigest"):
+        query = query.hexdigest()
+    if name not in ("ssdeep", "tlsh"):
+        raise ValueError("unsupported hash type %s" % name)
+    if isinstance(candidates, _Index):
+        return candidates.top_k(query, k)
+
+    scores = []
+    if name == "ssdeep":
+        compare = libssdeep_wrapper.compare
+        size = parse_ssdeep(query)[0]
+        # Only block sizes equal or a factor of two apart score above zero.
+        sizes = set(["%d" % size, "%d" % (size * 2), "%d" % (size // 2)])
+        for i, digest in enumerate(candidates):
+            if hasattr(digest, "hexdigest"):
+                digest = digest.hexdigest()
+            if digest[:digest.index(":")] not in sizes:
+                continue
+            score = compare(query, digest)
+            if score > 0:
+                scores.append((-score, i))
+        return [(i, -score) for score, i in heapq.nsmallest(k, scores)]
+    else:
+        diff = tlsh_wrapper.diff
+        for i, digest in enumerate(candidates):
+            if hasattr(digest, "hexdigest"):
+                digest = digest.hexdigest()
+            scores.append((diff(query, digest), i))
+        return [(i, score) for score, i in heapq.nsmallest(k, scores)]
+
+
+INDEXES = {
+    "ssdeep": SsdeepIndex,
+    "sdhash": SdhashIndex,
+    "tlsh": TlshIndex,
+}
+
+
+def new_index(name):
+    """Returns a new, empty index for the algorithm called name."""
+    try:
+        return INDEXES[name]()
+    except KeyError:
+        raise ValueError("unsupported hash type %s" % name)
+
+
+def _discard(buckets, bucket, key):
+    keys = buckets.get(bucket)
+    if keys is not None:
+        keys.discard(key)
+        if not keys:
+            del buckets[bucket]
@@ -6,6 +6,10 @@ from .common import find_library, load_library, tobyte, frombyte
 """
 A ctypes wrapper for ssdeep version 2.9
 
+Functions are loaded through ctypes.cdll, so the GIL is released for the
+duration of every call into libssdeep. A fuzzy_state must not be used by
+more than one thread at a time; fuzzy_compare has no shared state.
+
 [sptonkin@outlook.com]
 """
 
@@ -49,7 +53,8 @@ def fuzzy_clone(state):
 
 # fuzzy_free C API (from fuzzy.h)
 # extern void fuzzy_free(/*@only@*/ struct fuzzy_state *state);
-libssdeep.fuzzy_clone.argtypes = [c_void_p]
+libssdeep.fuzzy_free.restype = None
+libssdeep.fuzzy_free.argtypes = [c_void_p]
 
 
 def fuzzy_free(state):
@@ -86,6 +91,159 @@ def fuzzy_digest(state, flags):
     return frombyte(result).value
 
 
+# fuzzy_state contains no pointers, so like fuzzy_clone() its memory can be
+# copied to save or restore a state. Its size is not exported by libssdeep,
+# so is measured by fuzzy_state_size() within the bound of its allocation.
+try:
+    libc = CDLL(None)
+    libc.malloc_usable_size.restype = c_size_t
+    libc.malloc_usable_size.argtypes = [c_void_p]
+except AttributeError:
+    libc = None
+
+# Set by fuzzy_state_size() and library_id() when first used.
+_state_size = []
+_library_id = []
+
+# Prefixes states saved by fuzzy_save_state().
+STATE_MAGIC = "fuzzyhashlib-ssdeep-state"
+
+
+def fuzzy_state_size():
+    """Returns sizeof(struct fuzzy_state) for the loaded libssdeep.
+
+    This is the number of bytes fuzzy_clone() copies: a state's whole
+    allocation is filled with a pattern, cloned, and the clone compared
+    with it. Two patterns are used so that allocator slack in the clone
+    which happens to match cannot be mistaken for copied bytes."""
+    if not _state_size:
+        if libc is None:
+            raise SsdeepError("Cannot measure fuzzy_state on this platform.")
+        states = []
+        try:
+            size = None
+            for pattern in ("\xa5", "\x5a"):
+                state = fuzzy_new()
+                states.append(state)
+                usable = libc.malloc_usable_size(state)
+                memmove(state, pattern * usable, usable)
+                clone = fuzzy_clone(state)
+                states.append(clone)
+                copied = string_at(clone, usable)
+                matched = len(copied) - len(copied.lstrip(pattern))
+                size = matched if size is None else min(size, matched)
+        finally:
+            for state in states:
+                fuzzy_free(state)
+        _state_size.append(size)
+    return _state_size[0]
+
+
+def library_id():
+    """Returns the SHA-1 of the loaded libssdeep, identifying the layout of
+    the fuzzy_state it uses."""
+    if not _library_id:
+        import hashlib
+        with open(libssdeep_path, "rb") as lib:
+            _library_id.append(hashlib.sha1(lib.read()).hexdigest())
+    return _library_id[0]
+
+
+def fuzzy_get_state(state):
+    """Returns the contents of state as a string of bytes."""
+    return string_at(state, fuzzy_state_size())
+
+
+def fuzzy_set_state(state, data):
+    """Overwrites state with data previously returned by fuzzy_get_state()
+    in this process."""
+    if len(data) != fuzzy_state_size():
+        raise SsdeepError("Cannot restore fuzzy_state.")
+    memmove(state, data, len(data))
+
+
+def fuzzy_save_state(state):
+    """Returns the contents of state, prefixed by a header identifying the
+    libssdeep and fuzzy_state size it can be loaded with, for storage."""
+    return "%s:%s:%d:%s" % (STATE_MAGIC, library_id(), fuzzy_state_size(),
+                            fuzzy_get_state(state))
+
+
+def fuzzy_load_state(state, saved):
+    """Overwrites state with a state returned by fuzzy_save_state(). Raises
+    SsdeepError if it was saved by a different libssdeep."""
+    try:
+        magic, lib_id, size, data = saved.split(":", 3)
+        size = int(size)
+    except ValueError:
+        magic = lib_id = size = data = None
+    if magic != STATE_MAGIC or size != len(data or ""):
+        raise SsdeepError("Saved fuzzy_state is not in a known format.")
+    if lib_id != library_id() or size != fuzzy_state_size():
+        raise SsdeepError("Saved fuzzy_state was created by a different "
+                          "libssdeep (%s, %d bytes) than %s (%s, %d bytes)" %
+                          (lib_id, size, libssdeep_path, library_id(),
+                           fuzzy_state_size()))
+    fuzzy_set_state(state, data)
+
+
+# The contents of a new fuzzy_state, set by fuzzy_reset() when first used.
+_pristine = []
+
+
+def fuzzy_reset(state):
+    """Returns state to that of a newly created fuzzy_state, without freeing
+    and reallocating it."""
+    if not _pristine:
+        fresh = fuzzy_new()
+        try:
+            _pristine.append(fuzzy_get_state(fresh))
+        finally:
+            fuzzy_free(fresh)
+    fuzzy_set_state(state, _pristine[0])
+
+
+# fuzzy_hash_buf C API (from fuzzy.h)
+# extern int fuzzy_hash_buf(const unsigned char *buf,
+#            uint32_t buf_len,
+#            /*@out@*/ char *result);
+libssdeep.fuzzy_hash_buf.restype = c_int
+libssdeep.fuzzy_hash_buf.argtypes = [c_char_p, c_uint32, c_char_p]
+
+
+def fuzzy_hash_buffers(bufs, flags=0):
+    """Returns a list of digests, one for each buffer in bufs, using
+    libssdeep's fuzzy_hash_buf() with a single, reused result buffer.
+    fuzzy_hash_buf() takes no flags and a 32-bit length, so other buffers
+    are hashed with fuzzy_digest_buffer()."""
+    if flags:
+        return [fuzzy_digest_buffer(buf, flags) for buf in bufs]
+    result = create_string_buffer(FUZZY_MAX_RESULT)
+    # Bound locally, as this loop runs once per (typically small) buffer.
+    hash_buf = libssdeep.fuzzy_hash_buf
+    digests = []
+    append = digests.append
+    for buf in bufs:
+        buf = tobyte(buf)
+        if len(buf) > 0xffffffff:
+            append(tobyte(fuzzy_digest_buffer(buf)))
+            continue
+        if hash_buf(buf, len(buf), result):
+            raise SsdeepError("Could not create digest.")
+        append(result.value)
+    return [frombyte(d) for d in digests]
+
+
+def fuzzy_digest_buffer(buf, flags=0):
+    """Returns the digest of buf, using a new fuzzy_state."""
+    state = fuzzy_new()
+    try:
+        fuzzy_update(state, buf)
+        return fuzzy_digest(state, flags)
+    finally:
+        fuzzy_free(state)
+
+
 # fuzzy_set_total_input_length C API (from fuzzy.h)
 # extern int fuzzy_set_total_input_length(struct fuzzy_state *state, uint_least64_t total_fixed_length);
 # libssdeep.fuzzy_set_total_input_length.restype = c_int
@@ -104,3 +262,10 @@ def compare(sig1, sig2):
 
     Note: This function wraps ssdeep's fuzzy_compare function."""
     return libssdeep.fuzzy_compare(sig1, sig2)
+
+
+# As above, but taking the addresses of NUL terminated signatures, so that
+# signatures already in memory (eg. shared between processes) can be
+# compared without copying them.
+fuzzy_compare_addresses = CFUNCTYPE(c_int, c_void_p, c_void_p)(
+    ("fuzzy_compare", libssdeep))
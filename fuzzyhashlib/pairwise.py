@@ -0,0 +1,233 @@
+from __future__ import print_function, absolute_import
+
+from ctypes import addressof, c_char, c_ulonglong, memmove
+from multiprocessing import Pool, cpu_count
+from multiprocessing.sharedctypes import RawArray
+
+from . import libssdeep_wrapper
+from . import tlsh_wrapper
+from .index import DEFAULT_THRESHOLDS, parse_ssdeep, parse_tlsh, \
+    tlsh_lvalues
+
+"""
+Compares every digest of a corpus with every other (all_pairs()), or every
+digest of a set of queries with every digest of a corpus (query_corpus()),
+using a pool of worker processes.
+
+Digests are packed into fixed width records in shared memory, which worker
+processes inherit rather than receiving pickled copies of. The grid of
+comparisons is split into square tiles of tile_size digests, each worker
+comparing one tile at a time and returning only the matching pairs.
+
+Pairs which cannot match are never compared. Digests are sorted by a key,
+their ssdeep block size or tlsh length value, and only digests whose keys
+are compatible are compared:
+
+    * ssdeep - digests whose block sizes are not equal, or a factor of two
+      apart, always score 0
+    * tlsh - digests whose length values alone contribute more than the
+      threshold to diff() (see fuzzyhashlib.index.tlsh_lvalues()) cannot
+      match
+
+Tiles with no compatible keys are skipped entirely. Within a tile, each
+row is compared only with the runs of columns having compatible keys, so
+no pair is checked in Python before calling the native compare.
+
+sdhash is not supported, as sdbf digests must be parsed before comparing.
+
+[sptonkin@outlook.com]
+"""
+
+
+class PackedDigests(object):
+    """A list of digests packed into NUL terminated records of equal width
+    in memory that can be shared with child processes."""
+
+    def __init__(self, digests):
+        digests = list(digests)
+        self.count = len(digests)
+        self.width = max([len(digest) for digest in digests] + [0]) + 1
+        packed = "".join(digest.ljust(self.width, "\0") for digest in digests)
+        self.data = RawArray(c_char, max(len(packed), 1))
+        memmove(self.data, packed, len(packed))
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, i):
+        start = i * self.width
+        return self.data[start:start + self.width].rstrip("\0")
+
+    def address(self, i):
+        """Returns the address of the i'th digest."""
+        return addressof(self.data) + i * self.width
+
+
+def _sort_key(name, digest):
+    if name == "ssdeep":
+        return parse_ssdeep(digest)[0]
+    return parse_tlsh(digest)[1]
+
+
+def _compatible_keys(name, key, threshold):
+    # The keys of digests which may match a digest with key.
+    if name == "ssdeep":
+        keys = [key, key * 2]
+        if key % 2 == 0:
+            keys.append(key // 2)
+        return keys
+    return tlsh_lvalues(key, threshold)
+
+
+def _sorted(name, digests):
+    # Returns (digests, keys, order) with digests sorted by key, where
+    # order[i] is the original position of the i'th sorted digest.
+    keys = [_sort_key(name, digest) for digest in digests]
+    order = sorted(range(len(digests)), key=keys.__getitem__)
+    return ([digests[i] for i in order], [keys[i] for i in order], order)
+
+
+# Worker process state, set by _init_worker().
+_name = None
+_rows = None
+_cols = None
+_row_keys = None
+_col_keys = None
+_threshold = None
+
+
+def _init_worker(name, rows, cols, row_keys, col_keys, threshold):
+    global _name, _rows, _cols, _row_keys, _col_keys, _threshold
+    _name = name
+    _rows = rows
+    _cols = cols
+    _row_keys = row_keys
+    _col_keys = col_keys
+    _threshold = threshold
+
+
+def _runs(keys, start, end):
+    # Returns a dict of key to the [first, last) range of keys[start:end],
+    # which is sorted, holding it.
+    runs = {}
+    for j in range(start, end):
+        run = runs.get(keys[j])
+        if run is None:
+            runs[keys[j]] = [j, j + 1]
+        else:
+            run[1] = j + 1
+    return runs
+
+
+def _compare_tile(tile):
+    row_start, row_end, col_start, col_end, diagonal = tile
+    runs = _runs(_col_keys, col_start, col_end)
+    compatible = {}
+    if _name == "ssdeep":
+        compare = libssdeep_wrapper.fuzzy_compare_addresses
+        row_base, row_width = addressof(_rows.data), _rows.width
+        col_base, col_width = addressof(_cols.data), _cols.width
+        rows = [row_base + i * row_width for i in range(row_start, row_end)]
+        cols = [col_base + j * col_width for j in range(col_start, col_end)]
+        # fuzzy_compare() returns -1 on error.
+        low, high = max(_threshold, 1), 100
+    else:
+        compare = tlsh_wrapper.diff
+        rows = [_rows[i] for i in range(row_start, row_end)]
+        cols = [_cols[j] for j in range(col_start, col_end)]
+        low, high = 0, _threshold
+    matches = []
+    for i in range(row_start, row_end):
+        key = _row_keys[i]
+        if key not in compatible:
+            compatible[key] = [runs[other] for other in
+                               _compatible_keys(_name, key, _threshold)
+                               if other in runs]
+        digest = rows[i - row_start]
+        for first, last in compatible[key]:
+            if diagonal:
+                first = max(first, i + 1)
+            for j in range(first, last):
+                score = compare(digest, cols[j - col_start])
+                if low <= score <= high:
+                    matches.append((i, j, score))
+    return matches
+
+
+def _tiles(name, row_keys, col_keys, threshold, tile_size, symmetric):
+    # Yields the tiles whose rows and columns have compatible keys.
+    col_blocks = [set(col_keys[start:start + tile_size])
+                  for start in range(0, len(col_keys), tile_size)]
+    for row_start in range(0, len(row_keys), tile_size):
+        row_end = min(row_start + tile_size, len(row_keys))
+        compatible = set()
+        for key in set(row_keys[row_start:row_end]):
+            compatible.update(_compatible_keys(name, key, threshold))
+        first = row_start if symmetric else 0
+        for col_start in range(first, len(col_keys), tile_size):
+            if compatible.isdisjoint(col_blocks[col_start // tile_size]):
+                continue
+            col_end = min(col_start + tile_size, len(col_keys))
+            yield (row_start, row_end, col_start, col_end,
+                   symmetric and row_start == col_start)
+
+
+def _shared_keys(keys):
+    shared = RawArray(c_ulonglong, max(len(keys), 1))
+    shared[:len(keys)] = keys
+    return shared
+
+
+def _run(name, rows, cols, threshold, processes, tile_size, symmetric):
+    if name not in ("ssdeep", "tlsh"):
+        raise ValueError("unsupported hash type %s" % name)
+    if threshold is None:
+        threshold = DEFAULT_THRESHOLDS[name]
+    rows, row_keys, row_order = _sorted(name, list(rows))
+    if symmetric:
+        cols, col_keys, col_order = rows, row_keys, row_order
+    else:
+        cols, col_keys, col_order = _sorted(name, list(cols))
+    packed_rows = PackedDigests(rows)
+    packed_cols = packed_rows if symmetric else PackedDigests(cols)
+    shared_row_keys = _shared_keys(row_keys)
+    shared_col_keys = shared_row_keys if symmetric else _shared_keys(col_keys)
+
+    tiles = _tiles(name, row_keys, col_keys, threshold, tile_size, symmetric)
+    # Shared memory is inherited by forked processes rather than pickled.
+    pool = Pool(processes or cpu_count(), _init_worker,
+                (name, packed_rows, packed_cols, shared_row_keys,
+                 shared_col_keys, threshold))
+    try:
+        matches = []
+        for tile_matches in pool.imap_unordered(_compare_tile, tiles):
+            for i, j, score in tile_matches:
+                i, j = row_order[i], col_order[j]
+                if symmetric and i > j:
+                    i, j = j, i
+                matches.append((i, j, score))
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+    matches.sort()
+    return matches
+
+
+def all_pairs(digests, name, threshold=None, processes=None, tile_size=1024):
+    """Returns a sorted list of (i, j, score) for every pair of digests
+    digests[i] and digests[j], where i < j, which match at threshold.
+
+    name is the algorithm of the digests, either "ssdeep" or "tlsh".
+    threshold is a minimum score for ssdeep and a maximum distance for tlsh,
+    and defaults to fuzzyhashlib.index.DEFAULT_THRESHOLDS. processes
+    defaults to the number of CPUs."""
+    return _run(name, digests, None, threshold, processes, tile_size, True)
+
+
+def query_corpus(queries, corpus, name, threshold=None, processes=None,
+                 tile_size=1024):
+    """Returns a sorted list of (i, j, score) for every pair of digests
+    queries[i] and corpus[j] which match at threshold. Arguments are as
+    for all_pairs()."""
+    return _run(name, queries, corpus, threshold, processes, tile_size, False)
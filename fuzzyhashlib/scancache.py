@@ -0,0 +1,136 @@
+from __future__ import print_function, absolute_import
+
+import os
+import sqlite3
+
+"""
+A persistent cache of file digests for repeated scans, stored in SQLite.
+
+Digests are keyed by the (device, inode, size, mtime_ns) of the file they
+were computed from, so a file which has not changed since it was last
+hashed need not be read again. As the key does not include the path, a
+renamed or moved file (on the same device) is still found in the cache.
+
+The cache is opened in SQLite's WAL mode and every write is a single
+transaction, so any number of scanners may share one cache. Digests are
+only stored if the file was not modified while it was being hashed.
+
+[sptonkin@outlook.com]
+"""
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    device INTEGER NOT NULL,
+    inode INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    algorithm TEXT NOT NULL,
+    digest TEXT,
+    path TEXT NOT NULL,
+    PRIMARY KEY (device, inode, algorithm)
+);
+"""
+
+
+def _signed(value):
+    # SQLite integers are signed 64-bit; device and inode numbers may not be.
+    return value - (1 << 64) if value >= (1 << 63) else value
+
+
+def file_key(st):
+    """Returns the (device, inode, size, mtime_ns) cache key of the
+    os.stat() result st."""
+    mtime_ns = getattr(st, "st_mtime_ns", None)
+    if mtime_ns is None:
+        mtime_ns = int(round(st.st_mtime * 1000000000))
+    return (_signed(st.st_dev), _signed(st.st_ino), st.st_size, mtime_ns)
+
+
+class ScanCache(object):
+    """A SQLite backed cache of the digests of files.
+
+    Methods:
+
+    get() -- returns the cached digests of a file
+    put() -- stores the digests of a file
+    prune() -- removes entries for files which no longer exist
+    close() -- closes the cache"""
+
+    def __init__(self, path, timeout=30.0):
+        """Opens (creating if needed) the cache at path. timeout is the
+        number of seconds to wait for another writer to finish."""
+        self.path = path
+        self._conn = sqlite3.connect(path, timeout=timeout)
+        self._conn.text_factory = str
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        with self._conn:
+            self._conn.executescript(SCHEMA)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __len__(self):
+        """Returns the number of files in the cache."""
+        return self._conn.execute(
+            "SELECT COUNT(*) FROM (SELECT DISTINCT device, inode FROM files)"
+            ).fetchone()[0]
+
+    def close(self):
+        self._conn.close()
+
+    def get(self, key, algorithms):
+        """Returns (digests, path) for the file with key (see file_key()),
+        where digests is a dict of algorithm name to digest for those of
+        algorithms which are cached, and path is where the file was last
+        seen (None if it is not cached). Digests are None for algorithms
+        which could not hash the file."""
+        device, inode, size, mtime_ns = key
+        digests, path = {}, None
+        for name, digest, path in self._conn.execute(
+                "SELECT algorithm, digest, path FROM files WHERE device = ? "
+                "AND inode = ? AND size = ? AND mtime_ns = ?",
+                (device, inode, size, mtime_ns)):
+            if name in algorithms:
+                digests[name] = digest
+        return digests, path
+
+    def put(self, key, path, digests):
+        """Stores digests, a dict of algorithm name to digest (or None),
+        for the file at path with key. Entries for earlier versions of the
+        file are replaced, and cached digests are moved to path."""
+        device, inode, size, mtime_ns = key
+        with self._conn:
+            self._conn.execute(
+                "DELETE FROM files WHERE device = ? AND inode = ? AND "
+                "(size != ? OR mtime_ns != ?)",
+                (device, inode, size, mtime_ns))
+            self._conn.execute(
+                "UPDATE files SET path = ? WHERE device = ? AND inode = ?",
+                (path, device, inode))
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO files (device, inode, size, "
+                "mtime_ns, algorithm, digest, path) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [(device, inode, size, mtime_ns, name, digest, path)
+                 for name, digest in digests.items()])
+
+    def prune(self):
+        """Removes entries for files which no longer exist at the path
+        they were last seen at. Returns the number of files removed."""
+        stale = []
+        for device, inode, path in self._conn.execute(
+                "SELECT DISTINCT device, inode, path FROM files").fetchall():
+            try:
+                key = file_key(os.stat(path))
+            except (IOError, OSError):
+                key = None
+            if key is None or key[:2] != (device, inode):
+                stale.append((device, inode))
+        with self._conn:
+            self._conn.executemany(
+                "DELETE FROM files WHERE device = ? AND inode = ?", stale)
+        return len(stale)
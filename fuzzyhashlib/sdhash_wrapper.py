@@ -1,6 +1,8 @@
 from __future__ import print_function
 import sys
 import os
+import threading
+from collections import OrderedDict
 
 from . common import find_library
 
@@ -9,6 +11,9 @@ Shim between fuzzyhashlib code and sdhash's existing sdbf_class module (which
 imports from _sdbf_class.so, which needs to be added to the path for 
 importing).
 
+Note that the SWIG generated bindings do not release the GIL, so sdbf
+construction and compare() calls made from several threads are serialised.
+
 [sptonkin@outlook.com]
 """
 
@@ -34,5 +39,88 @@ def sdbf_from_buffer(buf, name=None):
     return sdbf_class.sdbf(name, buf, 0, len(buf), None)
 
 
-def sdbf_from_hash(sdhash):
+def sdbf_from_hash(sdhash, cache=True):
+    """Returns a sdbf parsed from the digest sdhash. Unless cache is False,
+    a previously parsed sdbf for the same digest is returned if it is still
+    in sdbf_cache."""
+    if cache:
+        return sdbf_cache.get(sdhash)
     return sdbf_class.sdbf(sdhash)
+
+
+# Default total length of the digests whose sdbfs sdbf_cache keeps.
+SDBF_CACHE_BYTES = 16 * 1024 * 1024
+
+
+class SdbfCache(object):
+    """A least recently used cache of sdbf objects keyed by their digest.
+    Cached sdbf objects are shared, so must not be modified.
+
+    The cache is bounded by the total length of the cached digests, which
+    is roughly proportional to the memory their sdbfs use, rather than by
+    their number, as sdhash digests grow with the length of their input.
+    Digests longer than maxbytes are parsed but not cached, so a maxbytes
+    of 0 disables the cache.
+
+    Methods:
+
+    get() -- returns the sdbf for a digest, parsing it if not cached
+    put() -- caches the sdbf for a digest
+    resize() -- changes maxbytes, evicting sdbfs as needed
+    clear() -- removes every sdbf from the cache
+
+    Attributes:
+
+    maxbytes -- the maximum total length of the cached digests
+    nbytes -- the total length of the cached digests"""
+
+    def __init__(self, maxbytes=SDBF_CACHE_BYTES):
+        self.maxbytes = maxbytes
+        self.nbytes = 0
+        self._lock = threading.Lock()
+        self._sdbfs = OrderedDict()
+
+    def __len__(self):
+        return len(self._sdbfs)
+
+    def get(self, sdhash):
+        """Returns the sdbf for sdhash, parsing and caching it if needed."""
+        with self._lock:
+            sdbf = self._sdbfs.pop(sdhash, None)
+            if sdbf is not None:
+                self._sdbfs[sdhash] = sdbf
+                return sdbf
+        sdbf = sdbf_class.sdbf(sdhash)
+        self.put(sdhash, sdbf)
+        return sdbf
+
+    def put(self, sdhash, sdbf):
+        """Caches sdbf as the parsed form of sdhash, unless sdhash is longer
+        than maxbytes."""
+        with self._lock:
+            if self._sdbfs.pop(sdhash, None) is not None:
+                self.nbytes -= len(sdhash)
+            if len(sdhash) <= self.maxbytes:
+                self._sdbfs[sdhash] = sdbf
+                self.nbytes += len(sdhash)
+            self._evict()
+
+    def resize(self, maxbytes):
+        """Sets maxbytes, evicting the least recently used sdbfs until the
+        cache fits."""
+        with self._lock:
+            self.maxbytes = maxbytes
+            self._evict()
+
+    def clear(self):
+        with self._lock:
+            self._sdbfs.clear()
+            self.nbytes = 0
+
+    def _evict(self):
+        while self.nbytes > self.maxbytes:
+            sdhash, _ = self._sdbfs.popitem(last=False)
+            self.nbytes -= len(sdhash)
+
+
+sdbf_cache = SdbfCache()
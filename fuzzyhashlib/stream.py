@@ -0,0 +1,158 @@
+from __future__ import print_function, absolute_import
+
+import os
+import stat
+
+import fuzzyhashlib
+
+"""
+Hashing of streams (pipes, sockets, decompressors) as data arrives.
+
+ssdeep and tlsh are updated with each chunk, so use a fixed amount of
+memory however long the stream is. sdhash can only hash a complete buffer,
+so its input is kept in memory until the stream ends; once more than
+sdhash_limit bytes have been seen it is discarded and sdhash gives no
+digest for the stream. A sdhash_limit of None buffers streams of any
+length.
+
+Buffered chunks are joined into a single string to be hashed, so the peak
+memory used for sdhash is about twice the length of the stream (and so at
+most twice sdhash_limit). hash_stream() avoids this for regular files,
+whose length is known: a file no longer than sdhash_limit is read in one
+piece, which sdhash hashes without copying, so the peak is about the
+file's length. A longer file is not buffered at all.
+
+[sptonkin@outlook.com]
+"""
+
+
+# Default maximum number of bytes buffered for sdhash.
+SDHASH_STREAM_LIMIT = 64 * 1024 * 1024
+
+# Default size of reads from file-like objects.
+CHUNK_SIZE = 64 * 1024
+
+
+class StreamHasher(object):
+    """Computes digests of a stream of chunks for several algorithms.
+
+    Methods:
+
+    update() -- updates the digests with the next chunk of the stream
+    passthrough() -- updates with, and yields, each chunk of an iterable
+    digests() -- returns the hash objects for the stream
+
+    Attributes:
+
+    algorithms -- the names of the algorithms being used
+    length -- the number of bytes seen so far"""
+
+    def __init__(self, algorithms=("ssdeep",),
+                 sdhash_limit=SDHASH_STREAM_LIMIT, size=None):
+        """size is the length of the stream, if known in advance; sdhash
+        input is not buffered at all if it is more than sdhash_limit."""
+        for name in algorithms:
+            if name not in fuzzyhashlib.algorithms_available:
+                raise ValueError("unsupported hash type %s" % name)
+        self.algorithms = tuple(algorithms)
+        self.length = 0
+        self.sdhash_limit = sdhash_limit
+        self._hashes = {}
+        self._sdhash_chunks = [] if "sdhash" in self.algorithms else None
+        if size is not None and sdhash_limit is not None and \
+                size > sdhash_limit:
+            self._sdhash_chunks = None
+
+    def update(self, chunk):
+        """Updates the digests with chunk."""
+        if not chunk:
+            return
+        self.length += len(chunk)
+        for name in self.algorithms:
+            if name == "sdhash":
+                if self._sdhash_chunks is not None:
+                    if self.sdhash_limit is not None and \
+                            self.length > self.sdhash_limit:
+                        self._sdhash_chunks = None
+                    else:
+                        self._sdhash_chunks.append(chunk)
+            elif name in self._hashes:
+                self._hashes[name].update(chunk)
+            else:
+                self._hashes[name] = fuzzyhashlib.new(name, buf=chunk)
+
+    def passthrough(self, chunks):
+        """Yields each chunk of the iterable chunks, having updated the
+        digests with it, so that a stream can be hashed as it is passed on
+        elsewhere."""
+        for chunk in chunks:
+            self.update(chunk)
+            yield chunk
+
+    def digests(self):
+        """Returns a dict of algorithm name to hash object. Algorithms which
+        could not hash the stream (eg. because it is too short, or too long
+        for sdhash) map to None. Note that this will 'finalise' tlsh."""
+        digests = {}
+        for name in self.algorithms:
+            digests[name] = None
+            try:
+                if name == "sdhash":
+                    if self._sdhash_chunks is None:
+                        continue
+                    # Joining a single chunk returns it without a copy.
+                    h = fuzzyhashlib.sdhash("".join(self._sdhash_chunks))
+                else:
+                    if name in self._hashes:
+                        h = self._hashes[name]
+                    else:
+                        h = fuzzyhashlib.new(name, buf="")
+                    # tlsh raises ValueError if the stream is too short.
+                    h.hexdigest()
+                digests[name] = h
+            except ValueError:
+                pass
+        return digests
+
+
+def iter_chunks(stream, chunk_size=CHUNK_SIZE):
+    """Yields chunks of stream, which may be a file-like object (read in
+    chunk_size pieces) or any iterable of strings."""
+    if hasattr(stream, "read"):
+        while True:
+            chunk = stream.read(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+    else:
+        for chunk in stream:
+            yield chunk
+
+
+def remaining_size(stream):
+    """Returns the number of bytes left to read from stream if it is a
+    regular file, otherwise None."""
+    try:
+        st = os.fstat(stream.fileno())
+        if not stat.S_ISREG(st.st_mode):
+            return None
+        return max(st.st_size - stream.tell(), 0)
+    except (AttributeError, IOError, OSError, ValueError):
+        return None
+
+
+def hash_stream(stream, algorithms=("ssdeep",), chunk_size=CHUNK_SIZE,
+                sdhash_limit=SDHASH_STREAM_LIMIT):
+    """Returns a dict of algorithm name to hash object for the contents of
+    stream, which may be a file-like object or any iterable of strings, as
+    for StreamHasher.digests(). A regular file no longer than sdhash_limit
+    is read in one piece if sdhash is used, so that it is only held in
+    memory once."""
+    size = remaining_size(stream) if "sdhash" in algorithms else None
+    hasher = StreamHasher(algorithms, sdhash_limit, size)
+    if size is not None and (sdhash_limit is None or size <= sdhash_limit):
+        # Read any more than size too, in case the file has grown.
+        chunk_size = max(size + 1, chunk_size)
+    for chunk in iter_chunks(stream, chunk_size):
+        hasher.update(chunk)
+    return hasher.digests()
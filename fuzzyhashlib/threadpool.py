@@ -0,0 +1,80 @@
+from __future__ import print_function, absolute_import
+
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
+
+import fuzzyhashlib
+
+"""
+Thread pool based hashing of many buffers.
+
+Threads share the buffers they hash with the caller, so unlike a process
+pool nothing is pickled or copied. How well this scales depends on whether
+the backend releases the GIL while in native code (see the releases_gil
+attribute of each hash class):
+
+    * ssdeep - released for update, digest and compare; scales with cores
+    * sdhash - held; work is serialised but remains correct
+    * tlsh - held; work is serialised but remains correct
+
+[sptonkin@outlook.com]
+"""
+
+
+class ThreadPoolHasher(object):
+    """Hashes buffers with a pool of worker threads.
+
+    Methods:
+
+    map() -- returns a list of hash objects, one per buffer
+    imap() -- as map(), but returns an iterator yielding results in order
+    compare() -- compares pairs of hash objects, returning a list of scores
+    close() -- stops the worker threads
+
+    Attributes:
+
+    name -- the name of the algorithm being used (eg. "ssdeep")
+    threads -- the number of worker threads
+    parallel -- True if the algorithm can use more than one core"""
+
+    def __init__(self, name="ssdeep", threads=None):
+        """Initialises a ThreadPoolHasher for the algorithm called name,
+        which must be one of fuzzyhashlib.algorithms_available. threads
+        defaults to the number of CPUs on the system."""
+        if name not in fuzzyhashlib.algorithms_available:
+            raise ValueError("unsupported hash type %s" % name)
+        self.name = name
+        self.threads = threads or cpu_count()
+        self.parallel = getattr(fuzzyhashlib, name).releases_gil
+        self._pool = ThreadPool(self.threads)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _hash(self, buf):
+        return fuzzyhashlib.new(self.name, buf=buf)
+
+    def map(self, bufs, chunksize=1):
+        """Returns a list of hash objects for each buffer in bufs."""
+        return self._pool.map(self._hash, bufs, chunksize)
+
+    def imap(self, bufs, chunksize=1):
+        """Returns an iterator of hash objects for each buffer in bufs."""
+        return self._pool.imap(self._hash, bufs, chunksize)
+
+    def compare(self, pairs, chunksize=1):
+        """Returns a list of compare() scores for each (a, b) pair of hash
+        objects in pairs."""
+        return self._pool.map(_compare_pair, pairs, chunksize)
+
+    def close(self):
+        """Stops the worker threads once outstanding work is complete."""
+        self._pool.close()
+        self._pool.join()
+
+
+def _compare_pair(pair):
+    return pair[0].compare(pair[1])
@@ -7,6 +7,9 @@ from . common import find_library
 """
 Shim between fuzzyhashlib code and tlsh's existing tlsh.so python extension.
 
+Note that the tlsh.so extension does not release the GIL, so Tlsh update(),
+final() and diff() calls made from several threads are serialised.
+
 [sptonkin@outlook.com]
 """
 
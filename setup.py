@@ -57,6 +57,9 @@ setup(
     long_description=open('README.rst').read(),
     license="GNU General Public License v3",
     install_requires = [],
+    entry_points={
+        'console_scripts': ['fuzzyhashlib = fuzzyhashlib.cli:main'],
+    },
     platforms=['linux'],
     classifiers=[
         'Development Status :: 3 - Alpha',
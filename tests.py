@@ -2,8 +2,33 @@ import unittest
 import os
 import resource
 import base64
+import json
+import pickle
+import threading
+import time
+import multiprocessing
+import random
+import shutil
+import tempfile
+from StringIO import StringIO
 
 import fuzzyhashlib
+from fuzzyhashlib import cascade
+from fuzzyhashlib import cli
+from fuzzyhashlib import db
+from fuzzyhashlib import index
+from fuzzyhashlib import pairwise
+from fuzzyhashlib import scancache
+
+def rss_kb():
+    """Returns the current RSS of this process in KB."""
+    try:
+        with open("/proc/self/statm") as statm:
+            pages = int(statm.read().split()[1])
+        return pages * resource.getpagesize() // 1024
+    except IOError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
 
 class BaseFuzzyHashTest(unittest.TestCase):
     """Base fuzzyhashlib test class."""
@@ -122,17 +147,47 @@ class BaseFuzzyHashTest(unittest.TestCase):
         with self.assertRaises(fuzzyhashlib.InvalidOperation) as exc:
             h3.update("this should error")
 
+    def test_hash_many(self):
+        digests = fuzzyhashlib.hash_many(
+            [self.test_data_1, self.test_data_2, self.test_data_1],
+            self.h1.name)
+        self.assertEqual(digests, [self.h1.hexdigest(), self.h2.hexdigest(),
+                                   self.h1.hexdigest()])
+
+    def test_pickle(self):
+        for protocol in range(pickle.HIGHEST_PROTOCOL + 1):
+            h3 = pickle.loads(pickle.dumps(self.h1, protocol))
+            self.assertEqual(h3, self.h1)
+            self.assertEqual(h3 - self.h1, 100)
+            h3 = pickle.loads(pickle.dumps(
+                self.FUZZY_HASH_CLASS(hash=self.h2.hexdigest()), protocol))
+            self.assertEqual(h3, self.h2)
+            with self.assertRaises(fuzzyhashlib.InvalidOperation):
+                h3.update("this should error")
+
+    def test_pickle_process_pool(self):
+        pool = multiprocessing.Pool(2)
+        try:
+            hashes = pool.map(self.FUZZY_HASH_CLASS,
+                              [self.test_data_1, self.test_data_2])
+        finally:
+            pool.close()
+            pool.join()
+        self.assertEqual(hashes, [self.h1, self.h2])
+
     def test_leak(self):
-        initial = resource.getrusage(resource.RUSAGE_SELF)[2]
-        threshold = initial + self.MEM_LEAK_TOLERANCE
         x = 0
         delta = 0
         buf = 100000 * chr(x & 0xff)
+        # Measured once buf and a first hash object exist, as current rather
+        # than peak RSS, so earlier tests (eg. pools) don't affect it.
+        h1 = self.FUZZY_HASH_CLASS(buf)
+        initial = rss_kb()
+        threshold = initial + self.MEM_LEAK_TOLERANCE
         while x < self.MEM_LEAK_ITERATIONS:
             # Compute hash for arbitrary data, check if more mem is used.
             h1 = self.FUZZY_HASH_CLASS(buf)
-            current = \
-                resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            current = rss_kb()
             delta = current - initial
             self.assertLessEqual(current, threshold,
                 "memory usage increased %s after %d iterations (%s); "
@@ -150,6 +205,46 @@ class TestSsdeep(BaseFuzzyHashTest):
         "TSEn7HbHR:U9vlKM1zJlFvmNz5VrlkTS07Ht"
 
 
+    def test_pickle_in_progress(self):
+        half = len(self.test_data_1) // 2
+        h3 = fuzzyhashlib.ssdeep(self.test_data_1[:half])
+        h3 = pickle.loads(pickle.dumps(h3, pickle.HIGHEST_PROTOCOL))
+        h3.update(self.test_data_1[half:])
+        self.assertEqual(h3, self.h1)
+
+    def test_pickle_other_library(self):
+        wrapper = fuzzyhashlib.libssdeep_wrapper
+        saved = wrapper.fuzzy_save_state(self.h1._state)
+        self.assertEqual(len(saved.split(":", 3)[3]),
+                         wrapper.fuzzy_state_size())
+        state = wrapper.fuzzy_new()
+        try:
+            for other in (saved.replace(wrapper.library_id(), "0" * 40),
+                          saved[:-1], "not a state"):
+                with self.assertRaises(wrapper.SsdeepError):
+                    wrapper.fuzzy_load_state(state, other)
+            wrapper.fuzzy_load_state(state, saved)
+            self.assertEqual(wrapper.fuzzy_digest(state, 0),
+                             self.h1.hexdigest())
+        finally:
+            wrapper.fuzzy_free(state)
+
+    def test_reset(self):
+        state = self.h2._state
+        self.h2.reset()
+        self.h2.update(self.test_data_1)
+        self.assertIs(self.h2._state, state)
+        self.assertEqual(self.h2, self.h1)
+        # Objects created from a hash have no state until they are reset.
+        h3 = fuzzyhashlib.ssdeep(hash=self.h1.hexdigest())
+        self.assertIsNone(h3._state)
+        self.assertEqual(h3.copy(), self.h1)
+        h3.reset()
+        h3.update(self.test_data_2)
+        self.assertEqual(h3.hexdigest(),
+                         fuzzyhashlib.ssdeep(self.test_data_2).hexdigest())
+
+
 class TestSdhash(BaseFuzzyHashTest):
     """Test fuzzyhashlib.sdhash"""
 
@@ -175,6 +270,42 @@ class TestSdhash(BaseFuzzyHashTest):
         self.assertEquals(context.exception.message,
                           "sdhash does not support update()")
 
+    def test_hexdigest_memoised(self):
+        self.assertIs(self.h1.hexdigest(), self.h1.hexdigest())
+        h3 = self.h1.copy()
+        self.assertIs(h3._sdbf, self.h1._sdbf)
+        self.assertIs(h3.hexdigest(), self.h1.hexdigest())
+
+    def test_parse_cache(self):
+        digest = self.h2.hexdigest()
+        fuzzyhashlib.sdhash_wrapper.sdbf_cache.clear()
+        h3 = fuzzyhashlib.sdhash(hash=digest)
+        h4 = fuzzyhashlib.sdhash(hash=digest)
+        self.assertIs(h3._sdbf, h4._sdbf)
+        self.assertEqual(h4.hexdigest(), digest)
+        self.assertEqual(h3 - self.h2, 100)
+
+    def test_parse_cache_bounded(self):
+        digest1, digest2 = self.h1.hexdigest(), self.h2.hexdigest()
+        cache = fuzzyhashlib.sdhash_wrapper.SdbfCache(
+            maxbytes=max(len(digest1), len(digest2)))
+        first = cache.get(digest1)
+        cache.get(digest2)
+        self.assertEqual(len(cache), 1)
+        self.assertEqual(cache.nbytes, len(digest2))
+        self.assertIsNot(cache.get(digest1), first)
+        cache.resize(0)
+        self.assertEqual((len(cache), cache.nbytes), (0, 0))
+        cache.get(digest1)
+        self.assertEqual(len(cache), 0)
+
+    def test_hash_not_reserialised(self):
+        digest = self.h2.hexdigest()
+        h3 = fuzzyhashlib.sdhash(hash=digest.rstrip("\n"))
+        self.assertEqual(h3.hexdigest(), digest)
+        self.assertEqual(h3, self.h2)
+
+
 class TestTlsh(BaseFuzzyHashTest):
     """Test fuzzyhashlib.tlsh"""
 
@@ -186,8 +317,704 @@ class TestTlsh(BaseFuzzyHashTest):
     MEM_LEAK_ITERATIONS = 10000
     MEM_LEAK_TOLERANCE = 1024
 
+    def test_hash_many_small_buffer(self):
+        self.assertEqual(fuzzyhashlib.hash_many(["buffer_too_short"], "tlsh"),
+                         [None])
+
     def test_invalid_buffer_size_raises(self):
         with self.assertRaises(ValueError) as context:
             fuzzyhashlib.tlsh("buffer_too_short").hexdigest()
         self.assertTrue(
             context.exception.message.startswith("tlsh requires buffer"))
+
+    def test_low_variation_raises(self):
+        h = fuzzyhashlib.tlsh("\0" * 1000)
+        for method in (h.hexdigest, h.copy, lambda: pickle.dumps(h),
+                       lambda: h.diff(self.h1)):
+            with self.assertRaises(ValueError):
+                method()
+        h.reset()
+        h.update(self.test_data_1)
+        self.assertEqual(h, self.h1)
+
+    def test_reset(self):
+        self.h2.hexdigest()
+        self.h2.reset()
+        self.h2.update(self.test_data_1)
+        self.assertEqual(self.h2, self.h1)
+        # Objects created from a hash have no Tlsh until they are reset.
+        h3 = fuzzyhashlib.tlsh(hash=self.h1.hexdigest().lower())
+        self.assertIsNone(h3._tlsh)
+        self.assertEqual(h3, self.h1)
+        h3.reset()
+        h3.update(self.test_data_2)
+        self.assertEqual(h3.hexdigest(),
+                         fuzzyhashlib.tlsh(self.test_data_2).hexdigest())
+        with self.assertRaises(ValueError):
+            fuzzyhashlib.tlsh(hash="not a tlsh digest")
+
+
+class TestHasherPool(unittest.TestCase):
+    """Test fuzzyhashlib.HasherPool"""
+
+    def setUp(self):
+        self.bufs = related_buffers(20)
+
+    def test_hexdigest(self):
+        for name in ("ssdeep", "tlsh"):
+            pool = fuzzyhashlib.HasherPool(name)
+            self.assertEqual([pool.hexdigest(buf) for buf in self.bufs],
+                             fuzzyhashlib.hash_many(self.bufs, name))
+        with self.assertRaises(ValueError):
+            fuzzyhashlib.HasherPool("tlsh").hexdigest("short")
+        with self.assertRaises(ValueError):
+            fuzzyhashlib.HasherPool("sdhash")
+
+    def test_reuse(self):
+        pool = fuzzyhashlib.HasherPool("ssdeep", size=1)
+        with pool.hasher() as h:
+            h.update(self.bufs[0])
+            self.assertEqual(h, fuzzyhashlib.ssdeep(self.bufs[0]))
+        with pool.hasher() as h2:
+            self.assertIs(h2, h)
+            h2.update(self.bufs[1])
+            self.assertEqual(h2, fuzzyhashlib.ssdeep(self.bufs[1]))
+            h3 = pool.acquire()
+            self.assertIsNot(h3, h2)
+            pool.release(h3)
+        self.assertEqual(len(pool), 1)
+        with self.assertRaises(fuzzyhashlib.InvalidOperation):
+            fuzzyhashlib.HasherPool("tlsh").acquire()
+
+
+class TestThreadPoolHasher(unittest.TestCase):
+    """Test fuzzyhashlib.ThreadPoolHasher"""
+
+    BUF_SIZE = 1024 * 1024
+    BUF_COUNT = 8
+
+    def setUp(self):
+        self.bufs = [os.urandom(self.BUF_SIZE) for _ in range(self.BUF_COUNT)]
+
+    def test_matches_serial(self):
+        for name in ("ssdeep", "tlsh"):
+            expected = [fuzzyhashlib.new(name, buf=buf).hexdigest()
+                        for buf in self.bufs]
+            with fuzzyhashlib.ThreadPoolHasher(name, threads=4) as hasher:
+                computed = [h.hexdigest() for h in hasher.map(self.bufs)]
+                scores = hasher.compare([(h, h) for h in hasher.imap(self.bufs)])
+            self.assertEqual(expected, computed)
+            self.assertEqual(scores, [100] * self.BUF_COUNT)
+
+    def test_shared_object(self):
+        # Concurrent updates to one object must not corrupt native state.
+        h = fuzzyhashlib.ssdeep(buf="")
+        chunk = self.bufs[0][:65536]
+        threads = [threading.Thread(target=lambda: [h.update(chunk)
+                                                    for _ in range(32)])
+                   for _ in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        expected = fuzzyhashlib.ssdeep(buf=chunk * 128)
+        self.assertEqual(h, expected)
+
+    def test_ssdeep_releases_gil(self):
+        # A Python thread can only make progress while ssdeep is hashing if
+        # the GIL has been released around the native call.
+        progress = []
+        done = threading.Event()
+        def spin():
+            while not done.is_set():
+                progress.append(None)
+        spinner = threading.Thread(target=spin)
+        spinner.start()
+        try:
+            time.sleep(0.05)
+            before = len(progress)
+            fuzzyhashlib.ssdeep(buf=self.bufs[0] * 4)
+            during = len(progress) - before
+        finally:
+            done.set()
+            spinner.join()
+        self.assertGreater(during, 0)
+
+    def test_ssdeep_thread_scaling(self):
+        cpus = multiprocessing.cpu_count()
+        if cpus < 2:
+            raise unittest.SkipTest("thread scaling requires >= 2 CPUs")
+        # Enough work (about a second serially) that scheduling noise
+        # doesn't matter. Threads running in parallel use more CPU time
+        # than the wall clock time taken, however busy the machine is.
+        bufs = [buf * 8 for buf in self.bufs]
+        with fuzzyhashlib.ThreadPoolHasher("ssdeep",
+                                           threads=min(cpus, 4)) as hasher:
+            start, cpu_start = time.time(), sum(os.times()[:2])
+            hasher.map(bufs)
+            wall = time.time() - start
+            cpu = sum(os.times()[:2]) - cpu_start
+        self.assertGreater(cpu, wall * 1.2)
+
+
+def related_buffers(count, seed=0):
+    """Returns count buffers of words, several of which are similar."""
+    rand = random.Random(seed)
+    words = ["".join(rand.choice("abcdefghij")
+                     for _ in range(rand.randint(2, 8))) for _ in range(500)]
+    bases = [[rand.choice(words) for _ in range(rand.randint(300, 3000))]
+             for _ in range(4)]
+    bufs = []
+    for i in range(count):
+        buf = list(bases[i % len(bases)])
+        for _ in range(rand.randint(0, len(buf) // 4)):
+            buf[rand.randint(0, len(buf) - 1)] = rand.choice(words)
+        bufs.append(" ".join(buf[:rand.randint(len(buf) // 2, len(buf))]))
+    return bufs
+
+
+class TestIndex(unittest.TestCase):
+    """Test fuzzyhashlib.index"""
+
+    def setUp(self):
+        self.bufs = related_buffers(120)
+
+    def assertSearchMatchesBruteForce(self, name, threshold):
+        idx = index.new_index(name)
+        digests = [fuzzyhashlib.new(name, buf=buf).hexdigest()
+                   for buf in self.bufs]
+        for key, digest in enumerate(digests):
+            idx.add(key, digest)
+        found = 0
+        for digest in digests:
+            expected = set(key for key, other in enumerate(digests)
+                           if idx.matches(idx.score(digest, other), threshold))
+            self.assertEqual(set(key for key, score
+                                 in idx.search(digest, threshold)), expected)
+            found += len(expected)
+        # Ensure matches other than self were found.
+        self.assertGreater(found, len(digests))
+
+    def test_ssdeep(self):
+        self.assertSearchMatchesBruteForce("ssdeep", 1)
+
+    def test_tlsh(self):
+        self.assertSearchMatchesBruteForce("tlsh", 50)
+
+    def test_tlsh_header_diff_is_lower_bound(self):
+        digests = [fuzzyhashlib.tlsh(buf).hexdigest() for buf in self.bufs]
+        headers = [index.parse_tlsh(digest) for digest in digests]
+        for a in range(0, len(digests), 10):
+            for b in range(len(digests)):
+                self.assertLessEqual(
+                    index.tlsh_header_diff(headers[a], headers[b]),
+                    fuzzyhashlib.tlsh_wrapper.diff(digests[a], digests[b]))
+
+    def test_top_k(self):
+        for name in ("ssdeep", "tlsh"):
+            idx = index.new_index(name)
+            digests = fuzzyhashlib.hash_many(self.bufs, name)
+            for i, digest in enumerate(digests):
+                idx.add(i, digest)
+            for query in digests[:10]:
+                scores = [(i, idx.score(query, digest))
+                          for i, digest in enumerate(digests)]
+                if name == "ssdeep":
+                    expected = sorted([s for s in scores if s[1]],
+                                      key=lambda s: (-s[1], s[0]))
+                else:
+                    expected = sorted(scores, key=lambda s: (s[1], s[0]))
+                for k in (0, 1, 5, len(digests) + 1):
+                    self.assertEqual(index.top_k(query, digests, k, name),
+                                     expected[:k])
+                    self.assertEqual(index.top_k(query, idx, k, name),
+                                     expected[:k])
+        hashes = [fuzzyhashlib.tlsh(buf) for buf in self.bufs[:5]]
+        self.assertEqual(index.top_k(hashes[0], hashes, 1), [(0, 0)])
+        with self.assertRaises(ValueError):
+            index.top_k(digests[0], digests, 1, "sdhash")
+
+    def test_remove(self):
+        idx = index.SsdeepIndex()
+        digest = fuzzyhashlib.ssdeep(self.bufs[0]).hexdigest()
+        idx.add("a", digest)
+        idx.remove("a")
+        self.assertEqual(len(idx), 0)
+        self.assertEqual(idx.search(digest, 1), [])
+        with self.assertRaises(KeyError):
+            idx.remove("a")
+
+
+class TestCli(unittest.TestCase):
+    """Test fuzzyhashlib.cli"""
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.paths = []
+        for i, buf in enumerate(related_buffers(8)):
+            path = os.path.join(self.dir, "file%d" % i)
+            with open(path, "wb") as f:
+                f.write(buf)
+            self.paths.append(path)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def run_cli(self, *argv):
+        stdout = StringIO()
+        status = cli.main(["-j", "2"] + list(argv), stdout=stdout)
+        self.assertEqual(status, 0)
+        return stdout.getvalue()
+
+    def test_native_ssdeep(self):
+        lines = self.run_cli(self.dir).splitlines()
+        self.assertEqual(lines[0], cli.SSDEEP_HEADER)
+        self.assertEqual(lines[1], '%s,"%s"' % (
+            fuzzyhashlib.ssdeep(open(self.paths[0], "rb").read()).hexdigest(),
+            self.paths[0]))
+        self.assertEqual(len(lines), len(self.paths) + 1)
+
+    def test_sdhash_limit(self):
+        path, digests, error = cli.hash_file(self.paths[0], ["sdhash"],
+                                             sdhash_limit=1024)
+        self.assertEqual(digests, {"sdhash": None})
+        status = cli.main(["-l", "-1", self.dir], stdout=StringIO(),
+                          stderr=StringIO())
+        self.assertEqual(status, 2)
+
+    def test_native_requires_one_algorithm(self):
+        status = cli.main(["-a", "ssdeep,tlsh", self.dir],
+                          stdout=StringIO(), stderr=StringIO())
+        self.assertEqual(status, 2)
+
+    def test_round_trip(self):
+        for fmt, algorithms in (("native", "ssdeep"), ("native", "tlsh"),
+                                ("csv", "ssdeep,tlsh"),
+                                ("jsonl", "ssdeep,tlsh")):
+            output = self.run_cli("-a", algorithms, "-f", fmt, self.dir)
+            digests = list(cli.read_digests(StringIO(output)))
+            expected = []
+            for path in self.paths:
+                buf = open(path, "rb").read()
+                for name in algorithms.split(","):
+                    expected.append(
+                        (path, name, fuzzyhashlib.new(name, buf=buf).hexdigest()))
+            self.assertEqual(sorted(digests), sorted(expected))
+
+    def test_match(self):
+        db = os.path.join(self.dir, "db.csv")
+        with open(db, "w") as f:
+            f.write(self.run_cli("-a", "ssdeep,tlsh", "-f", "csv",
+                                 *self.paths[:4]))
+        query = os.path.join(self.dir, "query")
+        with open(query, "wb") as f:
+            f.write(open(self.paths[1], "rb").read() + "appended")
+        output = self.run_cli("-a", "ssdeep,tlsh", "-f", "jsonl", "-m", db,
+                              query)
+        matches = [json.loads(line) for line in output.splitlines()]
+        expected = "%s:%s" % (db, self.paths[1])
+        for name in ("ssdeep", "tlsh"):
+            self.assertIn((name, expected),
+                          [(m["algorithm"], m["match"]) for m in matches])
+
+    def test_jsonl_undecodable_filename(self):
+        path = os.path.join(self.dir, "bad\xff.txt")
+        shutil.copy(self.paths[0], path)
+        output = self.run_cli("-a", "ssdeep", "-f", "jsonl", path,
+                              self.paths[1])
+        self.assertIn(u"bad\udcff.txt", json.loads(output.splitlines()[0])[
+            "filename"])
+        self.assertEqual([filename for filename, _, _ in
+                          cli.read_digests(StringIO(output))],
+                         [path, self.paths[1]])
+        for name in ("caf\xc3\xa9", "\xed\xb3\xbf\xff", "\xf0\x9f\x98\x80\xff",
+                     "plain"):
+            self.assertEqual(cli.encode_path(cli.decode_path(name)), name)
+        self.assertEqual(cli.decode_path("caf\xc3\xa9"), u"caf\xe9")
+
+    def test_unreadable_directory(self):
+        unreadable = os.path.join(self.dir, "unreadable")
+        os.mkdir(unreadable)
+        os.chmod(unreadable, 0)
+        try:
+            if os.access(unreadable, os.R_OK):
+                raise unittest.SkipTest("directory permissions not enforced")
+            stdout, stderr = StringIO(), StringIO()
+            status = cli.main(["-j", "2", self.dir], stdout=stdout,
+                              stderr=stderr)
+        finally:
+            os.chmod(unreadable, 0o700)
+        self.assertEqual(status, 1)
+        self.assertIn(unreadable, stderr.getvalue())
+        self.assertEqual(len(stdout.getvalue().splitlines()),
+                         len(self.paths) + 1)
+
+    def test_match_native(self):
+        # As in the README, match output needs no single algorithm.
+        known = os.path.join(self.dir, "known.csv")
+        with open(known, "w") as f:
+            f.write(self.run_cli("-a", "ssdeep,tlsh", "-f", "csv",
+                                 *self.paths[:4]))
+        output = self.run_cli("-a", "ssdeep,tlsh", "-m", known,
+                              *self.paths[:4])
+        for path in self.paths[:4]:
+            self.assertIn("%s matches %s:%s (100)" % (path, known, path),
+                          output.splitlines())
+
+    def test_native_filename_like_header(self):
+        path = os.path.join(self.dir, "filename,1")
+        shutil.copy(self.paths[0], path)
+        for name in ("ssdeep", "tlsh"):
+            output = self.run_cli("-a", name, path, self.paths[1])
+            self.assertEqual(
+                [(filename, algorithm) for filename, algorithm, _
+                 in cli.read_digests(StringIO(output))],
+                [(path, name), (self.paths[1], name)])
+
+    def test_thresholds(self):
+        self.assertEqual(cli.parse_thresholds(None, ["ssdeep", "tlsh"]),
+                         {"ssdeep": 1, "tlsh": 30})
+        self.assertEqual(cli.parse_thresholds("tlsh=50,ssdeep=30",
+                                              ["ssdeep", "tlsh"]),
+                         {"ssdeep": 30, "tlsh": 50})
+        self.assertEqual(cli.parse_thresholds("50", ["tlsh"]), {"tlsh": 50})
+        for value in ("50", "sdhash=1", "tlsh=x"):
+            with self.assertRaises(ValueError):
+                cli.parse_thresholds(value, ["ssdeep", "tlsh"])
+        stderr = StringIO()
+        self.assertEqual(cli.main(["-a", "ssdeep,tlsh", "-f", "csv",
+                                   "-t", "50", self.dir], stdout=StringIO(),
+                                  stderr=stderr), 2)
+        self.assertIn("NAME=50", stderr.getvalue())
+
+    def test_scan_cache(self):
+        cache = os.path.join(self.dir, "cache.db")
+        expected = self.run_cli("-a", "ssdeep,tlsh", "-f", "csv", *self.paths)
+        for _ in range(2):
+            self.assertEqual(self.run_cli("-a", "ssdeep,tlsh", "-f", "csv",
+                                          "-c", cache, *self.paths), expected)
+        with scancache.ScanCache(cache) as scan_cache:
+            self.assertEqual(len(scan_cache), len(self.paths))
+
+    def test_hash_file_cached(self):
+        path = self.paths[0]
+        buf = open(path, "rb").read()
+        with scancache.ScanCache(os.path.join(self.dir, "cache.db")) as cache:
+            digests = cli.hash_file(path, ["ssdeep"], cache)[1]
+            self.assertEqual(digests["ssdeep"],
+                             fuzzyhashlib.ssdeep(buf).hexdigest())
+            # Unchanged files are not read again, even once renamed.
+            key = scancache.file_key(os.stat(path))
+            cache.put(key, path, {"ssdeep": "cached"})
+            renamed = os.path.join(self.dir, "renamed")
+            os.rename(path, renamed)
+            self.assertEqual(cli.hash_file(renamed, ["ssdeep"], cache)[1],
+                             {"ssdeep": "cached"})
+            self.assertEqual(cache.get(key, ["ssdeep"]),
+                             ({"ssdeep": "cached"}, renamed))
+            # Only algorithms which are not cached are computed.
+            digests = cli.hash_file(renamed, ["ssdeep", "tlsh"], cache)[1]
+            self.assertEqual(digests, {
+                "ssdeep": "cached", "tlsh": fuzzyhashlib.tlsh(buf).hexdigest()})
+            # Modified files are hashed again.
+            with open(renamed, "ab") as f:
+                f.write("appended")
+            os.utime(renamed, (0, 12345))
+            digests = cli.hash_file(renamed, ["ssdeep"], cache)[1]
+            self.assertEqual(digests["ssdeep"],
+                             fuzzyhashlib.ssdeep(buf + "appended").hexdigest())
+            self.assertEqual(cache.get(key, ["ssdeep", "tlsh"]), ({}, None))
+            self.assertEqual(cache.prune(), 0)
+            os.remove(renamed)
+            self.assertEqual(cache.prune(), 1)
+            self.assertEqual(len(cache), 0)
+
+class TestDigestDB(unittest.TestCase):
+    """Test fuzzyhashlib.db.DigestDB"""
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, "digests.db")
+        self.bufs = related_buffers(60)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_search_matches_index(self):
+        with db.DigestDB(self.path) as digest_db:
+            for name, threshold in (("ssdeep", 1), ("tlsh", 50)):
+                idx = index.new_index(name)
+                hashes = [fuzzyhashlib.new(name, buf=buf)
+                          for buf in self.bufs]
+                for i, h in enumerate(hashes):
+                    idx.add(digest_db.add(h, name="buf%d" % i,
+                                          metadata={"i": i}),
+                            h.hexdigest())
+                for h in hashes:
+                    results = digest_db.search(h, threshold)
+                    self.assertEqual(
+                        sorted((record.id, score)
+                               for record, score in results),
+                        sorted(idx.search(h.hexdigest(), threshold)))
+                    for record, score in results:
+                        self.assertEqual(record.algorithm, name)
+                        self.assertEqual(record.name,
+                                         "buf%d" % record.metadata["i"])
+
+    def test_remove(self):
+        with db.DigestDB(self.path) as digest_db:
+            h = fuzzyhashlib.tlsh(self.bufs[0])
+            digest_id = digest_db.add(h)
+            self.assertEqual(digest_db.get(digest_id).digest, h.hexdigest())
+            digest_db.remove(digest_id)
+            self.assertEqual(len(digest_db), 0)
+            self.assertEqual(digest_db.search(h), [])
+            with self.assertRaises(KeyError):
+                digest_db.get(digest_id)
+            with self.assertRaises(KeyError):
+                digest_db.remove(digest_id)
+
+    def test_concurrent_connections(self):
+        h = fuzzyhashlib.ssdeep(self.bufs[0])
+        with db.DigestDB(self.path) as reader:
+            self.assertEqual(reader.search(h), [])
+            with db.DigestDB(self.path) as writer:
+                digest_id = writer.add(h.hexdigest(), name="a",
+                                       algorithm="ssdeep")
+            self.assertEqual([(record.id, score)
+                              for record, score in reader.search(h)],
+                             [(digest_id, 100)])
+        # Digests persist once the database is reopened.
+        with db.DigestDB(self.path) as digest_db:
+            self.assertEqual([record.name for record in digest_db.find("a")],
+                             ["a"])
+
+    def test_sdhash_parsed_once(self):
+        with db.DigestDB(self.path) as digest_db:
+            hashes = [fuzzyhashlib.sdhash(buf) for buf in self.bufs[:3]]
+            ids = [digest_db.add(h) for h in hashes]
+            self.assertEqual(digest_db.search(hashes[0])[0][0].id, ids[0])
+            parsed = dict(digest_db._sdhashes)
+            self.assertEqual(len(parsed), 3)
+            digest_db.search(hashes[1])
+            for digest, h in digest_db._sdhashes.items():
+                self.assertIs(h, parsed[digest])
+            # Searching a subset of the digests keeps the others.
+            digest_db.search(hashes[1], candidates=[digest_db.get(ids[1])])
+            self.assertEqual(len(digest_db._sdhashes), 3)
+            digest_db.remove(ids[2])
+            self.assertEqual(len(digest_db._sdhashes), 2)
+            digest_db.search(hashes[1])
+            self.assertEqual(len(digest_db._sdhashes), 2)
+
+
+class TestCascade(unittest.TestCase):
+    """Test fuzzyhashlib.cascade"""
+
+    stages = (("tlsh", 150), ("ssdeep", 1))
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.digest_db = db.DigestDB(os.path.join(self.dir, "digests.db"))
+        self.bufs = related_buffers(40)
+        for i, buf in enumerate(self.bufs):
+            for name in ("ssdeep", "tlsh"):
+                self.digest_db.add(fuzzyhashlib.new(name, buf=buf),
+                                   name="buf%d" % i)
+
+    def tearDown(self):
+        self.digest_db.close()
+        shutil.rmtree(self.dir)
+
+    def test_cascade_search(self):
+        for buf in self.bufs[:10]:
+            result = cascade.cascade_search(buf, self.digest_db, self.stages)
+            # Every match passes the last stage, and the first stage's.
+            expected = dict((record.name, score) for record, score in
+                            self.digest_db.search(fuzzyhashlib.ssdeep(buf)))
+            for name, scores in result.matches:
+                self.assertEqual(scores["ssdeep"], expected[name])
+                self.assertTrue(scores["tlsh"] <= 150)
+            scores = [scores["ssdeep"] for _, scores in result.matches]
+            self.assertEqual(scores, sorted(scores, reverse=True))
+            self.assertIn("buf%d" % self.bufs.index(buf), result.names)
+            first, last = result.stages
+            self.assertEqual(first.candidates, len(self.digest_db.candidates(
+                fuzzyhashlib.tlsh(buf), 150)))
+            self.assertTrue(first.passed <= first.candidates)
+            self.assertEqual(last.candidates, first.passed)
+            self.assertEqual(last.passed, len(result.matches))
+
+    def test_cascade_search_digests(self):
+        sample = {"ssdeep": fuzzyhashlib.ssdeep(self.bufs[0]),
+                  "tlsh": fuzzyhashlib.tlsh(self.bufs[0]).hexdigest()}
+        result = cascade.cascade_search(sample, self.digest_db, self.stages)
+        self.assertEqual(result.matches,
+                         cascade.cascade_search(self.bufs[0], self.digest_db,
+                                                self.stages).matches)
+        # Nothing is found for a sample too short for the first stage.
+        result = cascade.cascade_search("short", self.digest_db, self.stages)
+        self.assertEqual(result.matches, [])
+        self.assertEqual([stage.passed for stage in result.stages], [0, 0])
+        with self.assertRaises(ValueError):
+            cascade.cascade_search(self.bufs[0], self.digest_db, [])
+
+    def test_cascade_sdhash_parsed_once(self):
+        for i, buf in enumerate(self.bufs[:10]):
+            self.digest_db.add(fuzzyhashlib.sdhash(buf), name="buf%d" % i)
+        stages = (("tlsh", 150), ("sdhash", 1))
+        cache = fuzzyhashlib.sdhash_wrapper.sdbf_cache
+        maxbytes, parse = cache.maxbytes, cache.get
+        parsed = []
+
+        def counting_parse(digest):
+            parsed.append(digest)
+            return parse(digest)
+        cache.resize(0)
+        cache.get = counting_parse
+        try:
+            first = cascade.cascade_search(self.bufs[0], self.digest_db,
+                                           stages)
+            del parsed[:]
+            second = cascade.cascade_search(self.bufs[0], self.digest_db,
+                                            stages)
+        finally:
+            del cache.get
+            cache.resize(maxbytes)
+        self.assertEqual(first.matches, second.matches)
+        self.assertIn("buf0", second.names)
+        # Only the sample is parsed; references were parsed by the first.
+        self.assertEqual(len(parsed), 1)
+
+    def test_cascade_unnamed(self):
+        ids = [self.digest_db.add(fuzzyhashlib.tlsh(buf))
+               for buf in self.bufs[:2]]
+        result = cascade.cascade_search(self.bufs[0], self.digest_db,
+                                        self.stages[:1])
+        self.assertIn(ids[0], result.names)
+        self.assertIn("buf0", result.names)
+        self.assertEqual(len(result.names), len(set(result.names)))
+        # Unnamed references have no ssdeep digest to confirm them with.
+        result = cascade.cascade_search(self.bufs[0], self.digest_db,
+                                        self.stages)
+        self.assertNotIn(ids[0], result.names)
+        self.assertIn("buf0", result.names)
+
+    def test_cascade_recall(self):
+        report = cascade.cascade_recall(self.bufs[:5], self.digest_db,
+                                        self.stages)
+        self.assertEqual(report.samples, 5)
+        self.assertTrue(0.0 < report.recall <= 1.0)
+        self.assertEqual([stage.algorithm for stage in report.stages],
+                         ["tlsh", "ssdeep"])
+        self.assertEqual(report.stages[0].candidates, sum(
+            len(self.digest_db.candidates(fuzzyhashlib.tlsh(buf), 150))
+            for buf in self.bufs[:5]))
+        # A first stage which shortlists everything loses nothing.
+        report = cascade.cascade_recall(self.bufs[:5], self.digest_db,
+                                        (("tlsh", 10000), ("ssdeep", 1)))
+        self.assertEqual(report.recall, 1.0)
+
+
+class TestPairwise(unittest.TestCase):
+    """Test fuzzyhashlib.pairwise"""
+
+    def setUp(self):
+        self.bufs = related_buffers(150)
+
+    def brute_force(self, name, rows, cols, threshold, symmetric):
+        idx = index.new_index(name)
+        return [(i, j, idx.score(rows[i], cols[j]))
+                for i in range(len(rows))
+                for j in range(i + 1 if symmetric else 0, len(cols))
+                if idx.matches(idx.score(rows[i], cols[j]), threshold)]
+
+    def test_all_pairs(self):
+        for name, threshold in (("ssdeep", 1), ("tlsh", 100)):
+            digests = fuzzyhashlib.hash_many(self.bufs, name)
+            matches = pairwise.all_pairs(digests, name, threshold,
+                                         processes=2, tile_size=32)
+            self.assertTrue(matches)
+            self.assertEqual(matches, self.brute_force(name, digests, digests,
+                                                       threshold, True))
+
+    def test_query_corpus(self):
+        for name, threshold in (("ssdeep", 1), ("tlsh", 100)):
+            digests = fuzzyhashlib.hash_many(self.bufs, name)
+            queries, corpus = digests[:40], digests[40:]
+            matches = pairwise.query_corpus(queries, corpus, name, threshold,
+                                            processes=2, tile_size=25)
+            self.assertTrue(matches)
+            self.assertEqual(matches, self.brute_force(name, queries, corpus,
+                                                       threshold, False))
+
+    def test_unsupported(self):
+        with self.assertRaises(ValueError):
+            pairwise.all_pairs([], "sdhash")
+
+    def test_incompatible_tiles_skipped(self):
+        keys = [3] * 4 + [6] * 4 + [96] * 4
+        self.assertEqual(
+            [tile[:4] for tile in
+             pairwise._tiles("ssdeep", keys, keys, 1, 4, True)],
+            [(0, 4, 0, 4), (0, 4, 4, 8), (4, 8, 4, 8), (8, 12, 8, 12)])
+        lvalues = [10] * 2 + [100] * 2
+        self.assertEqual(
+            [tile[:4] for tile in
+             pairwise._tiles("tlsh", lvalues, lvalues, 100, 2, False)],
+            [(0, 2, 0, 2), (2, 4, 2, 4)])
+
+
+class TestStream(unittest.TestCase):
+    """Test fuzzyhashlib.hash_stream and fuzzyhashlib.StreamHasher"""
+
+    def setUp(self):
+        self.buf = related_buffers(1)[0]
+
+    def test_file(self):
+        digests = fuzzyhashlib.hash_stream(StringIO(self.buf),
+                                           ("ssdeep", "tlsh"), chunk_size=100)
+        self.assertEqual(digests["ssdeep"], fuzzyhashlib.ssdeep(self.buf))
+        self.assertEqual(digests["tlsh"], fuzzyhashlib.tlsh(self.buf))
+
+    def test_passthrough(self):
+        chunks = [self.buf[i:i + 37] for i in range(0, len(self.buf), 37)]
+        hasher = fuzzyhashlib.StreamHasher(("ssdeep", "tlsh"))
+        self.assertEqual(list(hasher.passthrough(iter(chunks))), chunks)
+        self.assertEqual(hasher.length, len(self.buf))
+        digests = hasher.digests()
+        self.assertEqual(digests["ssdeep"], fuzzyhashlib.ssdeep(self.buf))
+        self.assertEqual(digests["tlsh"], fuzzyhashlib.tlsh(self.buf))
+
+    def test_short_stream(self):
+        digests = fuzzyhashlib.hash_stream([], ("ssdeep", "tlsh", "sdhash"))
+        self.assertEqual(digests["ssdeep"], fuzzyhashlib.ssdeep(""))
+        self.assertEqual(digests["tlsh"], None)
+        self.assertEqual(digests["sdhash"], None)
+
+    def test_sdhash_limit(self):
+        hasher = fuzzyhashlib.StreamHasher(("sdhash",), sdhash_limit=1024)
+        hasher.update("a" * 1000)
+        hasher.update("a" * 1000)
+        self.assertEqual(hasher.digests(), {"sdhash": None})
+
+    def test_sdhash_size_over_limit(self):
+        hasher = fuzzyhashlib.StreamHasher(("sdhash",), sdhash_limit=1024,
+                                           size=2000)
+        hasher.update("a" * 1000)
+        self.assertEqual(hasher.digests(), {"sdhash": None})
+
+    def test_regular_file(self):
+        with tempfile.TemporaryFile() as f:
+            f.write(self.buf)
+            f.seek(100)
+            self.assertEqual(fuzzyhashlib.stream.remaining_size(f),
+                             len(self.buf) - 100)
+            f.seek(0)
+            digests = fuzzyhashlib.hash_stream(
+                f, ("ssdeep", "sdhash"), chunk_size=100,
+                sdhash_limit=len(self.buf) - 1)
+        self.assertEqual(digests["ssdeep"], fuzzyhashlib.ssdeep(self.buf))
+        self.assertEqual(digests["sdhash"], None)
+        self.assertEqual(fuzzyhashlib.stream.remaining_size(StringIO("a")),
+                         None)
@@ -0,0 +1,254 @@
+#!/usr/bin/env python
+"""Memory soak benchmark for fuzzyhashlib's native state handling.
+
+Repeats individual operations on each hash class for many iterations,
+sampling the resident set size (RSS) as it goes, to find leaks too small
+for tests.py's leak checks to notice. Each operation runs in its own
+process so that growth can be attributed to it.
+
+Usage:
+
+    python util/soak.py [-n ITERATIONS] [-s SAMPLES] [-t SECONDS]
+                        [--csv FILE] [OP ...]
+
+OP names an operation (eg. 'tlsh.abandoned') or a class (eg. 'tlsh'); by
+default every operation is run. A summary of RSS growth is printed for
+each operation and, with --csv, the sampled curves are written to FILE.
+Operations which crash (eg. a segfault in native code) or run for longer
+than -t SECONDS are reported as errors.
+
+[sptonkin@outlook.com]
+"""
+
+from __future__ import print_function
+
+import Queue
+import argparse
+import csv
+import multiprocessing
+import os
+import pickle
+import resource
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+import fuzzyhashlib
+
+
+def rss_kb():
+    """Returns the current RSS of this process in KB."""
+    try:
+        with open("/proc/self/statm") as statm:
+            pages = int(statm.read().split()[1])
+        return pages * resource.getpagesize() // 1024
+    except IOError:
+        # Peak rather than current RSS, but still shows steady growth.
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def buffer(size, seed=0):
+    """Returns size bytes of data which all of the algorithms can hash."""
+    return "".join(chr((i * 7919 + seed) % 251) for i in range(size))
+
+
+def class_operations(cls):
+    """Returns a dict of operation name to a function which, when called in
+    the process running the operation, returns a function performing one
+    iteration of it."""
+    def setup():
+        buf = buffer(4096)
+        return buf, cls(buf), cls(buffer(4096, seed=1))
+
+    def from_buf():
+        buf, _, _ = setup()
+        return lambda: cls(buf).hexdigest()
+
+    def from_hash():
+        _, h, _ = setup()
+        digest = h.hexdigest()
+        return lambda: cls(hash=digest)
+
+    def copy():
+        _, h, _ = setup()
+        return h.copy
+
+    def compare():
+        _, h, other = setup()
+        return lambda: h.compare(other)
+
+    def pickled():
+        _, h, _ = setup()
+        return lambda: pickle.loads(pickle.dumps(h, 2))
+
+    def hash_many():
+        bufs = [setup()[0]] * 4
+        return lambda: fuzzyhashlib.hash_many(bufs, cls.name)
+
+    return {
+        "%s.buf" % cls.name: from_buf,
+        "%s.hash" % cls.name: from_hash,
+        "%s.copy" % cls.name: copy,
+        "%s.compare" % cls.name: compare,
+        "%s.pickle" % cls.name: pickled,
+        "%s.hash_many" % cls.name: hash_many,
+    }
+
+
+def ssdeep_updatable():
+    h = fuzzyhashlib.ssdeep(buffer(2048))
+    return h.copy
+
+
+def ssdeep_pickle_updatable():
+    h = fuzzyhashlib.ssdeep(buffer(2048))
+    return lambda: pickle.loads(pickle.dumps(h, 2))
+
+
+def reset(cls):
+    # One object reused for every input, as HasherPool does for ssdeep.
+    def setup():
+        buf = buffer(4096)
+        h = cls(buf)
+
+        def op():
+            h.reset()
+            h.update(buf)
+            return h.hexdigest()
+        return op
+    return setup
+
+
+def tlsh_abandoned(size):
+    # Created from a buffer but never finalised, as tlsh.__del__ handles.
+    def setup():
+        buf = buffer(size)
+        return lambda: fuzzyhashlib.tlsh(buf)
+    return setup
+
+
+OPERATIONS = {
+    "ssdeep.copy_updatable": ssdeep_updatable,
+    "ssdeep.pickle_updatable": ssdeep_pickle_updatable,
+    "ssdeep.reset": reset(fuzzyhashlib.ssdeep),
+    "tlsh.reset": reset(fuzzyhashlib.tlsh),
+    "tlsh.abandoned": tlsh_abandoned(4096),
+    "tlsh.abandoned_small": tlsh_abandoned(100),
+}
+for _cls in (fuzzyhashlib.ssdeep, fuzzyhashlib.sdhash, fuzzyhashlib.tlsh):
+    OPERATIONS.update(class_operations(_cls))
+
+
+def soak(name, iterations, samples, results):
+    """Runs operation name for iterations, putting (name, samples, error)
+    on the results queue, where samples is a list of (iteration, RSS)."""
+    try:
+        op = OPERATIONS[name]()
+        interval = max(iterations // samples, 1)
+        # Warm up so allocator and interpreter caches are populated.
+        for _ in range(min(interval, 1000)):
+            op()
+        curve = [(0, rss_kb())]
+        # No range(), which would allocate a list after the first sample.
+        i = 0
+        while i < iterations:
+            op()
+            i += 1
+            if i % interval == 0 or i == iterations:
+                curve.append((i, rss_kb()))
+        results.put((name, curve, None))
+    except Exception as err:
+        results.put((name, None, "%s: %s" % (type(err).__name__, err)))
+
+
+def wait(process, results, timeout=None):
+    """Returns (curve, error) once the soak() running in process puts its
+    result on results, exits without doing so, or runs for longer than
+    timeout seconds (if given)."""
+    start = time.time()
+    while True:
+        try:
+            _, curve, error = results.get(timeout=1.0)
+            return curve, error
+        except Queue.Empty:
+            pass
+        if not process.is_alive():
+            # The result may have been put just before the process exited.
+            try:
+                _, curve, error = results.get(timeout=1.0)
+                return curve, error
+            except Queue.Empty:
+                code = process.exitcode
+                if code < 0:
+                    return None, "killed by signal %d" % -code
+                return None, "exited with code %d" % code
+        if timeout is not None and time.time() - start > timeout:
+            process.terminate()
+            return None, "timed out after %.0f seconds" % timeout
+
+
+def slope(curve):
+    """Returns the least squares RSS growth of curve in KB per million
+    iterations."""
+    n = float(len(curve))
+    mean_x = sum(x for x, _ in curve) / n
+    mean_y = sum(y for _, y in curve) / n
+    var = sum((x - mean_x) ** 2 for x, _ in curve)
+    if not var:
+        return 0.0
+    cov = sum((x - mean_x) * (y - mean_y) for x, y in curve)
+    return cov / var * 1000000
+
+
+def main(argv=None):
+    names = sorted(OPERATIONS)
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("ops", nargs="*", metavar="OP",
+                        help="operations or classes to run (default: all)")
+    parser.add_argument("-n", "--iterations", type=int, default=1000000,
+                        help="iterations per operation (default: 1000000)")
+    parser.add_argument("-s", "--samples", type=int, default=100,
+                        help="RSS samples per operation (default: 100)")
+    parser.add_argument("-t", "--timeout", type=float,
+                        help="seconds before an operation is stopped "
+                             "(default: none)")
+    parser.add_argument("--csv", help="write sampled RSS curves to this file")
+    args = parser.parse_args(argv)
+
+    selected = [name for name in names
+                if not args.ops or name in args.ops
+                or name.split(".")[0] in args.ops]
+    writer = None
+    if args.csv:
+        writer = csv.writer(open(args.csv, "w"), lineterminator="\n")
+        writer.writerow(["operation", "iteration", "rss_kb"])
+
+    print("%-26s %10s %10s %10s %14s %8s" % ("operation", "start KB",
+                                           "end KB", "growth KB",
+                                           "KB/1M iters", "seconds"))
+    status = 0
+    for name in selected:
+        results = multiprocessing.Queue()
+        start = time.time()
+        process = multiprocessing.Process(
+            target=soak, args=(name, args.iterations, args.samples, results))
+        process.start()
+        curve, error = wait(process, results, args.timeout)
+        process.join()
+        elapsed = time.time() - start
+        if error is not None:
+            print("%-26s %s" % (name, error))
+            status = 1
+            continue
+        print("%-26s %10d %10d %10d %14.1f %8.1f" % (
+            name, curve[0][1], curve[-1][1], curve[-1][1] - curve[0][1],
+            slope(curve), elapsed))
+        if writer is not None:
+            for iteration, rss in curve:
+                writer.writerow([name, iteration, rss])
+    return status
+
+
+if __name__ == "__main__":
+    sys.exit(main())